@@ -20,26 +20,172 @@
 # WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
 # OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
 # ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import mmap
 import struct
 
 INT_FORMATS = {1: 'b', 2: '>h', 4: '>i', 8: '>q'}
 UINT_FORMATS = {1: 'B', 2: '>H', 4: '>I', 8: '>Q'}
 
+# Precompiled codecs, so the format strings aren't parsed again on every read.
+INT_STRUCTS = dict((size, struct.Struct(fmt))
+        for size, fmt in INT_FORMATS.items())
+UINT_STRUCTS = dict((size, struct.Struct(fmt))
+        for size, fmt in UINT_FORMATS.items())
+DOUBLE_STRUCT = struct.Struct('>d')
+
+# Dispatch tables built so far, by class and then by method name prefix.
+_dispatch_tables = {}
+
+def register_handler(cls, prefix, key, func):
+    """Use 'func(reader)' as the handler for 'key' in the 'prefix' dispatch
+    table of 'cls' and its subclasses, unless a subclass has its own handler
+    for 'key'.  Readers created before this call keep their tables.
+    """
+    handlers = cls.__dict__.get('_registered_handlers')
+    if handlers is None:
+        handlers = {}
+        cls._registered_handlers = handlers
+    handlers.setdefault(prefix, {})[key] = func
+    _dispatch_tables.clear()
+
+def dispatch_table(cls, prefix):
+    """Return a dict mapping 4-character keys to the handlers of 'cls': its
+    methods named 'prefix' + key, with the key's trailing spaces dropped (so
+    'read_di_obj' handles 'obj '), and those added with 'register_handler'.
+    Handlers are collected along the MRO, so a subclass's handler for a key
+    wins over its bases'.
+    """
+    tables = _dispatch_tables.setdefault(cls, {})
+    table = tables.get(prefix)
+    if table is None:
+        table = {}
+        for klass in reversed(cls.__mro__):
+            for name, value in klass.__dict__.items():
+                if name.startswith(prefix):
+                    table[name[len(prefix):].ljust(4)] = value
+            table.update(klass.__dict__.get('_registered_handlers', {})
+                    .get(prefix, {}))
+        tables[prefix] = table
+    return table
+
+def map_stream(stream):
+    """Return a read-only buffer holding the contents of 'stream', or None if
+    'stream' can't be mapped into memory.  Byte strings, bytearrays,
+    memoryviews and mmaps are used directly; real files are mapped with mmap.
+    """
+    if isinstance(stream, (bytes, bytearray, memoryview, mmap.mmap)):
+        return stream
+
+    try:
+        fileno = stream.fileno()
+    except (AttributeError, IOError, ValueError):
+        return None
+
+    try:
+        return mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+    except (EnvironmentError, ValueError):
+        # Not a regular file (pipe, socket, ...) or an empty file.
+        return None
+
 class BinaryReader(object):
-    def __init__(self, stream):
-        self.stream = stream
+    # Method name prefixes that readers dispatch on; see 'dispatch_table'.
+    # Mixins add theirs.
+    DISPATCH_PREFIXES = ()
+
+    def __init__(self, stream, use_mmap=True):
+        """Read from 'stream', which may be a file-like object or any
+        bytes-like buffer.  Unless 'use_mmap' is False, files are mapped into
+        memory and decoded in place, which avoids one read() call per field.
+        """
         self.pos = 0
+        self.buf = map_stream(stream) if use_mmap else None
+        # Whether 'buf' is a mapping made by map_stream, which 'close' unmaps.
+        self.owns_buf = self.buf is not None and self.buf is not stream
+        self.closed = False
+        # Slices of strings and mmaps are strings already; other buffers'
+        # slices have to be converted.
+        self.slices_are_str = isinstance(self.buf, (bytes, mmap.mmap))
+
+        if self.buf is not None:
+            self.stream = None
+            # Positions are relative to where the stream was when we started.
+            self.offset = stream.tell() if hasattr(stream, 'tell') else 0
+        else:
+            self.stream = stream
+            self.offset = 0
+
+        # The handler tables, by prefix, resolved once per reader.
+        self.dispatch = {}
+        for klass in type(self).__mro__:
+            for prefix in klass.__dict__.get('DISPATCH_PREFIXES', ()):
+                self.dispatch[prefix] = dispatch_table(type(self), prefix)
+
 
+    def close(self):
+        """Unmap the file, if this reader mapped it.  The stream itself is
+        left open.
+
+        Everything that still reads the file on demand stops working:
+        buffers returned by 'read_view', the blocks of lazily read layers
+        (LazyLayerInfo) and layer images (LayerImage) that haven't been
+        decoded yet.  Those raise ValueError from then on.
+        """
+        self.closed = True
+        if self.owns_buf:
+            self.buf.close()
+            self.owns_buf = False
+
+    def check_open(self):
+        if self.closed:
+            raise ValueError('I/O operation on a closed reader')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     def read_raw(self, size):
         """Read raw data as an 8-bit string."""
+        if self.buf is not None:
+            start = self.offset + self.pos
+            self.pos += size
+            data = self.buf[start:start + size]
+            if self.slices_are_str:
+                return data
+            if isinstance(data, memoryview):
+                data = data.tobytes()
+            elif isinstance(data, bytearray):
+                data = bytes(data)
+            return data
+
         self.pos += size
         return self.stream.read(size)
 
     def skip(self, size):
         """Skip forward (or backward, if 'size' is negative) in the stream."""
         self.pos += size
-        self.stream.seek(size, 1)
+        if self.buf is None:
+            self.stream.seek(size, 1)
+
+    def read_span(self, start, end):
+        """Read the raw data between positions 'start' and 'end', without
+        moving the current position.
+        """
+        pos = self.pos
+        self.skip_to(start)
+        data = self.read_raw(end - start)
+        self.skip_to(pos)
+        return data
+
+    def read_view(self, start, end):
+        """Like 'read_span', but if the stream is mapped into memory, return
+        a read-only buffer that shares its memory instead of a copy.
+        """
+        self.check_open()
+        if self.buf is not None and not isinstance(self.buf, memoryview):
+            return buffer(self.buf, self.offset + start, end - start)
+        return self.read_span(start, end)
 
     def skip_to(self, pos):
         """Skip to a specified position in the stream."""
@@ -55,26 +201,31 @@ class BinaryReader(object):
         self.skip(alignment - size % alignment)
 
 
+    def read_struct(self, codec):
+        """Read the fields described by the struct.Struct 'codec' in a single
+        unpack, returning them as a tuple.
+        """
+        if self.buf is not None:
+            result = codec.unpack_from(self.buf, self.offset + self.pos)
+            self.pos += codec.size
+            return result
+        return codec.unpack(self.read_raw(codec.size))
+
     def read_int(self, size):
         """Read a signed, big-endian integer of 'size' bytes.  'size' must be
         1, 2, 4, or 8.
         """
-        assert size in INT_FORMATS
-        buf = self.read_raw(size)
-        result, = struct.unpack(INT_FORMATS[size], buf)
+        result, = self.read_struct(INT_STRUCTS[size])
         return result
 
     def read_uint(self, size):
         """Read an unsigned, big-endian integer of 'size' bytes.  'size' must
         be 1, 2, 4, or 8.
         """
-        assert size in UINT_FORMATS
-        buf = self.read_raw(size)
-        result, = struct.unpack(UINT_FORMATS[size], buf)
+        result, = self.read_struct(UINT_STRUCTS[size])
         return result
 
     def read_double(self):
         """Read a double (8 byte floating point number)."""
-        buf = self.read_raw(8)
-        result, = struct.unpack('>d', buf)
+        result, = self.read_struct(DOUBLE_STRUCT)
         return result
@@ -0,0 +1,205 @@
+# Copyright (c) 2012 Stuart Pernsteiner
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import errno
+import hashlib
+import os
+import tempfile
+import time
+
+# Bump this whenever a change to the converter changes its output, so results
+# cached by older versions are not reused.
+CONVERTER_VERSION = '7'
+
+# Entries being written have this suffix until they are renamed into place.
+TEMP_SUFFIX = '.tmp'
+
+# Temporary files older than this (in seconds) were left behind by a writer
+# that died, and are removed on eviction.
+STALE_TEMP_AGE = 3600
+
+# Once the cache is full, entries are evicted until it is this fraction of
+# 'max_bytes', so eviction (which lists the whole cache) runs only once in
+# a while.
+LOW_WATER = 0.75
+
+def hash_file(filename, chunk_size=1 << 20):
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def make_key(*parts):
+    """Build a cache key from the converter version and 'parts', which are
+    converted to strings with repr().
+    """
+    digest = hashlib.sha1(CONVERTER_VERSION)
+    for part in parts:
+        digest.update('\0')
+        digest.update(repr(part))
+    return digest.hexdigest()
+
+class CacheView(object):
+    """The entries of one kind (like layer fragments) in a ConversionCache,
+    with their own hit and miss counts.
+    """
+    def __init__(self, cache):
+        self.cache = cache
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        data = self.cache.read(key)
+        if data is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return data
+
+    def put(self, key, data):
+        self.cache.put(key, data)
+
+class ConversionCache(object):
+    """A content-addressed store of conversion results on disk.  Entries are
+    files named by their key; when the total size exceeds 'max_bytes', the
+    least recently used entries are removed until it is back under the low
+    water mark.  Per-layer fragments share the store through 'layers'.
+    """
+    def __init__(self, directory, max_bytes=256 << 20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+        # Estimated total size of the cache, computed on first use.
+        self.size = None
+
+        self.layers = CacheView(self)
+
+    def entry_path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def read(self, key):
+        """Return the data stored for 'key', or None, without counting a
+        hit or miss.
+        """
+        path = self.entry_path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            # Mark the entry as recently used.
+            os.utime(path, None)
+        except EnvironmentError:
+            return None
+        return data
+
+    def get(self, key, input_size=0):
+        """Return the data stored for 'key', or None.  On a hit,
+        'input_size' (the size of the input that no longer needs to be
+        converted) is added to 'bytes_saved'.
+        """
+        data = self.read(key)
+        if data is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.bytes_saved += input_size
+        return data
+
+    def put(self, key, data):
+        path = self.entry_path(key)
+        entry_dir = os.path.dirname(path)
+        try:
+            os.makedirs(entry_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        # Write to a temporary file and rename it into place, so concurrent
+        # readers (e.g. other batch workers) never see a partial entry.
+        fd, temp_path = tempfile.mkstemp(suffix=TEMP_SUFFIX, dir=entry_dir)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(temp_path, path)
+
+        if self.size is None:
+            self.size = self.total_size()
+        else:
+            self.size += len(data)
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def entries(self, remove_stale=False):
+        """List (mtime, size, path) for every entry in the cache.  Files
+        still being written (by this or another process) are left out; if
+        'remove_stale' is set, ones abandoned long ago are removed.
+        """
+        result = []
+        stale_time = time.time() - STALE_TEMP_AGE
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                    if filename.endswith(TEMP_SUFFIX):
+                        if remove_stale and st.st_mtime < stale_time:
+                            os.remove(path)
+                        continue
+                except OSError:
+                    continue
+                result.append((st.st_mtime, st.st_size, path))
+        return result
+
+    def total_size(self):
+        return sum(size for mtime, size, path in self.entries())
+
+    def evict(self):
+        """Remove least recently used entries until the cache is down to
+        LOW_WATER of 'max_bytes'.
+        """
+        entries = sorted(self.entries(remove_stale=True))
+        self.size = sum(size for mtime, size, path in entries)
+        target = int(self.max_bytes * LOW_WATER)
+        for mtime, size, path in entries:
+            if self.size <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.size -= size
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'bytes_saved': self.bytes_saved,
+            'layer_hits': self.layers.hits,
+            'layer_misses': self.layers.misses,
+        }
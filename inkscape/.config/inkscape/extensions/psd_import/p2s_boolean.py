@@ -0,0 +1,398 @@
+# Copyright (c) 2012 Stuart Pernsteiner
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""Boolean operations on subpaths, used to resolve PSD subpath combine modes
+into a single path without masks.
+
+Subpaths are flattened into polygons.  All polygon edges are split where
+they cross, and each piece is kept if the combined shape is inside on
+exactly one side of it.  The kept pieces are then linked into loops that
+all have the inside on their left, so the result can be filled with either
+fill rule.  Curves whose flattened edges all come through uncut are put
+back as the original cubics; only the curves cut by another subpath stay
+flattened.
+"""
+import math
+
+from .p2s_simplify import subpath_segments
+
+
+# Maximum distance (in pixels) between a curve and its flattened polygon.
+FLATTEN_TOLERANCE = 0.05
+
+# Coordinates are rounded to this many decimal places, so that the points
+# where edges are split match up exactly.
+SNAP_DIGITS = 6
+
+# PSD subpath combine modes.
+EXCLUDE = 0
+UNION = 1
+SUBTRACT = 2
+INTERSECT = 3
+CONTINUATION = -1
+
+def snap(point):
+    return (round(point[0], SNAP_DIGITS), round(point[1], SNAP_DIGITS))
+
+def flatten_cubic(p0, p1, p2, p3, tolerance, out, depth=0):
+    """Append points approximating the cubic from 'p0' to 'p3' (excluding
+    'p0') to 'out', subdividing until the control points are within
+    'tolerance' of the chord.
+    """
+    dx, dy = p3[0] - p0[0], p3[1] - p0[1]
+    length = math.hypot(dx, dy)
+    if length > 0:
+        d1 = abs((p1[0] - p3[0]) * dy - (p1[1] - p3[1]) * dx) / length
+        d2 = abs((p2[0] - p3[0]) * dy - (p2[1] - p3[1]) * dx) / length
+    else:
+        d1 = math.hypot(p1[0] - p0[0], p1[1] - p0[1])
+        d2 = math.hypot(p2[0] - p0[0], p2[1] - p0[1])
+    if d1 + d2 <= tolerance or depth >= 16:
+        out.append(p3)
+        return
+
+    # de Casteljau split at t = 0.5
+    mid = lambda a, b: ((a[0] + b[0]) / 2, (a[1] + b[1]) / 2)
+    p01, p12, p23 = mid(p0, p1), mid(p1, p2), mid(p2, p3)
+    p012, p123 = mid(p01, p12), mid(p12, p23)
+    center = mid(p012, p123)
+    flatten_cubic(p0, p01, p012, center, tolerance, out, depth + 1)
+    flatten_cubic(center, p123, p23, p3, tolerance, out, depth + 1)
+
+def flatten_subpath(subpath, tolerance=FLATTEN_TOLERANCE, curves=None):
+    """Flatten a subpath into a polygon (a list of points).  Open subpaths
+    are closed, as they are when filled.
+
+    If a dict 'curves' is given, each cubic that was flattened into more
+    than one edge is recorded in it for 'loop_segments', in both
+    directions: the first edge maps to the cubic's points on the polygon
+    and its two handles.
+    """
+    start, segments = subpath_segments(subpath)
+    points = [start]
+    pos = start
+    for command, coords in segments:
+        first = len(points) - 1
+        flatten_cubic(pos, coords[0:2], coords[2:4], coords[4:6], tolerance,
+                points)
+        if curves is not None and len(points) - first > 2:
+            chain = [snap(p) for p in points[first:]]
+            curves.setdefault((chain[0], chain[1]),
+                    (chain, coords[0:2] + coords[2:4]))
+            chain = chain[::-1]
+            curves.setdefault((chain[0], chain[1]),
+                    (chain, coords[2:4] + coords[0:2]))
+        pos = coords[4:6]
+    return [snap(p) for p in points]
+
+def box_polygon(bounds):
+    left, top = bounds['left'], bounds['top']
+    right, bottom = bounds['right'], bounds['bottom']
+    return [(left, top), (right, top), (right, bottom), (left, bottom)]
+
+def polygon_edges(polygon):
+    polygon = [snap(p) for p in polygon]
+    edges = []
+    for a, b in zip(polygon, polygon[1:] + polygon[:1]):
+        if a != b:
+            edges.append((a, b))
+    return edges
+
+
+def cross(o, a, b):
+    return (a[0] - o[0]) * (b[1] - o[1]) - (a[1] - o[1]) * (b[0] - o[0])
+
+def split_points(a, b, c, d):
+    """Return the points at which the segments a-b and c-d touch, as
+    (parameter along a-b, point) and (parameter along c-d, point) lists:
+    their crossing point, or for collinear segments, each one's endpoints
+    that lie on the other.  A shared point is computed once, so it is split
+    at identically on both edges.
+    """
+    r = (b[0] - a[0], b[1] - a[1])
+    s = (d[0] - c[0], d[1] - c[1])
+    denominator = r[0] * s[1] - r[1] * s[0]
+    qp = (c[0] - a[0], c[1] - a[1])
+    rr = r[0] * r[0] + r[1] * r[1]
+    ss = s[0] * s[0] + s[1] * s[1]
+
+    if abs(denominator) <= 1e-12 * rr * ss:
+        # parallel; only collinear overlaps matter
+        if rr == 0 or ss == 0 or abs(cross(a, b, c)) > 1e-9 * math.sqrt(rr):
+            return [], []
+        on_ab = [(((p[0] - a[0]) * r[0] + (p[1] - a[1]) * r[1]) / rr, p)
+                for p in (c, d)]
+        on_cd = [(((p[0] - c[0]) * s[0] + (p[1] - c[1]) * s[1]) / ss, p)
+                for p in (a, b)]
+        return ([(t, p) for t, p in on_ab if 0 < t < 1],
+                [(u, p) for u, p in on_cd if 0 < u < 1])
+
+    t = (qp[0] * s[1] - qp[1] * s[0]) / denominator
+    u = (qp[0] * r[1] - qp[1] * r[0]) / denominator
+    if not (0 <= t <= 1 and 0 <= u <= 1):
+        return [], []
+    if t == 0 or t == 1:
+        point = b if t else a
+    elif u == 0 or u == 1:
+        point = d if u else c
+    else:
+        point = snap((a[0] + r[0] * t, a[1] + r[1] * t))
+    return [(t, point)] if 0 < t < 1 else [], [(u, point)] if 0 < u < 1 else []
+
+def split_edges(edges):
+    """Split 'edges' ((a, b, operand) tuples) wherever they cross or
+    overlap.  Returns a dict mapping each piece, as a (p, q) pair with
+    p < q, to a dict of how many times each operand runs along it from p
+    to q (negative if it runs from q to p).
+    """
+    splits = [[] for edge in edges]
+
+    # Sweep along x, only testing edges whose x ranges overlap.
+    order = sorted(xrange(len(edges)),
+            key=lambda i: min(edges[i][0][0], edges[i][1][0]))
+    active = []
+    for i in order:
+        a, b = edges[i][:2]
+        min_x = min(a[0], b[0])
+        active = [j for j in active
+                if max(edges[j][0][0], edges[j][1][0]) >= min_x]
+        min_y, max_y = min(a[1], b[1]), max(a[1], b[1])
+        for j in active:
+            c, d = edges[j][:2]
+            if max(c[1], d[1]) < min_y or min(c[1], d[1]) > max_y:
+                continue
+            on_i, on_j = split_points(a, b, c, d)
+            splits[i].extend(on_i)
+            splits[j].extend(on_j)
+        active.append(i)
+
+    pieces = {}
+    for (a, b, operand), points in zip(edges, splits):
+        points = [a] + [p for t, p in sorted(points)] + [b]
+        for p, q in zip(points[:-1], points[1:]):
+            if p == q:
+                continue
+            key, weight = ((p, q), 1) if p < q else ((q, p), -1)
+            weights = pieces.setdefault(key, {})
+            weights[operand] = weights.get(operand, 0) + weight
+    return pieces
+
+
+class WindingIndex(object):
+    """Computes the winding numbers of points with respect to several
+    operands at once, from the weighted pieces returned by 'split_edges'.
+    Pieces are bucketed into horizontal bands, so each query only looks at
+    the pieces that span its band.
+    """
+    def __init__(self, pieces, count):
+        self.count = count
+        edges = [(p, q, weights.items())
+                for (p, q), weights in pieces.iteritems() if p[1] != q[1]]
+
+        ys = [point[1] for p, q, weights in edges for point in (p, q)] or [0]
+        self.top = min(ys)
+        self.band_count = max(int(math.sqrt(len(edges))), 1)
+        self.band_height = (max(ys) - self.top) / self.band_count or 1.0
+        self.bands = [[] for i in xrange(self.band_count)]
+        for edge in edges:
+            p, q = edge[0], edge[1]
+            first = self.band(min(p[1], q[1]))
+            last = self.band(max(p[1], q[1]))
+            for i in xrange(first, last + 1):
+                self.bands[i].append(edge)
+
+    def band(self, y):
+        index = int((y - self.top) / self.band_height)
+        return min(max(index, 0), self.band_count - 1)
+
+    def winding_numbers(self, point, exclude=None):
+        """Winding numbers of 'point', leaving out the piece 'exclude'.
+        Points on a horizontal line through a vertex count as lying just
+        below it (towards +y).
+        """
+        numbers = [0] * self.count
+        for p, q, weights in self.bands[self.band(point[1])]:
+            if p[1] <= point[1] < q[1]:
+                sign = 1 if cross(p, q, point) > 0 else 0
+            elif q[1] <= point[1] < p[1]:
+                sign = -1 if cross(p, q, point) < 0 else 0
+            else:
+                continue
+            if sign and (p, q) != exclude:
+                for operand, weight in weights:
+                    numbers[operand] += sign * weight
+        return numbers
+
+def combine_operands(operands, ops):
+    """Combine 'operands', each a (polygons, fill rule) pair, with the
+    boolean operations 'ops' (one per operand, applied in order starting
+    from the empty shape).  Returns the outline of the result as a list of
+    loops (lists of points), each with the inside on its left.
+    """
+    rules = [rule for polygons, rule in operands]
+
+    def inside(numbers):
+        result = False
+        for op, rule, number in zip(ops, rules, numbers):
+            contains = number % 2 != 0 if rule == 'evenodd' else number != 0
+            if op == UNION:
+                result = result or contains
+            elif op == SUBTRACT:
+                result = result and not contains
+            elif op == INTERSECT:
+                result = result and contains
+            elif op == EXCLUDE:
+                result = result != contains
+        return result
+
+    edges = []
+    for operand, (polygons, rule) in enumerate(operands):
+        for polygon in polygons:
+            edges.extend((a, b, operand) for a, b in polygon_edges(polygon))
+    pieces = split_edges(edges)
+    index = WindingIndex(pieces, len(operands))
+
+    kept = []
+    for (p, q), weights in pieces.iteritems():
+        # Only this piece passes through its midpoint, so the winding
+        # numbers on its two sides are those of the midpoint without it,
+        # and those changed by its own weights.
+        mid = ((p[0] + q[0]) / 2, (p[1] + q[1]) / 2)
+        base = index.winding_numbers(mid, (p, q))
+        shifted = list(base)
+        if q[1] > p[1]:
+            # A ray towards +x from the left of an upward piece crosses it.
+            for operand, weight in weights.iteritems():
+                shifted[operand] += weight
+            left, right = shifted, base
+        else:
+            # The left of a downward piece is towards +x.  For horizontal
+            # pieces, 'base' is that of a point just below, which is also
+            # the left.
+            for operand, weight in weights.iteritems():
+                shifted[operand] -= weight
+            left, right = base, shifted
+        if inside(left) and not inside(right):
+            kept.append((p, q))
+        elif inside(right) and not inside(left):
+            kept.append((q, p))
+
+    return link_loops(kept)
+
+def link_loops(edges):
+    """Link directed edges, which must form closed loops, into lists of
+    points.
+    """
+    outgoing = {}
+    for a, b in edges:
+        outgoing.setdefault(a, []).append(b)
+
+    loops = []
+    for start in list(outgoing):
+        while outgoing.get(start):
+            loop = [start]
+            point = outgoing[start].pop()
+            while point != start and outgoing.get(point):
+                loop.append(point)
+                point = outgoing[point].pop()
+            if len(loop) > 2:
+                loops.append(loop)
+    return loops
+
+def loop_segments(loop, curves):
+    """Turn a loop of points into a start point and segments (see
+    p2s_simplify), putting back the cubics recorded in 'curves' by
+    'flatten_subpath' wherever all of a cubic's points follow each other in
+    the loop.  The other edges become lines.
+    """
+    count = len(loop)
+    # Maps the index of the first point of each cubic found to the number
+    # of edges it spans and its handles.
+    found = {}
+    for i in xrange(count):
+        curve = curves.get((loop[i], loop[(i + 1) % count]))
+        if curve is None or len(curve[0]) - 1 > count:
+            continue
+        chain, handles = curve
+        if all(loop[(i + k) % count] == point
+                for k, point in enumerate(chain)):
+            found[i] = (len(chain) - 1, handles)
+
+    # Start at a point that isn't inside one of the cubics.
+    inner = set((i + k) % count for i, (edges, handles) in found.items()
+            for k in xrange(1, edges))
+    start = next((i for i in xrange(count) if i not in inner), 0)
+
+    segments = []
+    k = 0
+    while k < count:
+        i = (start + k) % count
+        edges, handles = found.get(i, (1, None))
+        if handles is None or k + edges > count:
+            segments.append(('L', loop[(i + 1) % count]))
+            k += 1
+        else:
+            segments.append(('C', handles + loop[(i + edges) % count]))
+            k += edges
+    return loop[start], segments
+
+def resolve_subpaths(subpaths, invert, bounds, tolerance=FLATTEN_TOLERANCE):
+    """Resolve the combine modes of PSD subpaths (and the vector mask's
+    'invert' flag) into loops describing the combined shape, each as a
+    start point and segments.  Curves that no other subpath cuts keep their
+    original form; the rest of the outline is made of lines within
+    'tolerance' of it.  As with masks, subtracting from nothing subtracts
+    from the whole 'bounds'.
+    """
+    operands = []
+    ops = []
+    curves = {}
+    for subpath in subpaths:
+        polygon = flatten_subpath(subpath, tolerance, curves)
+        mode = subpath['combine_mode']
+        if mode == CONTINUATION and operands:
+            # Another part of the previous subpath; the parts are filled
+            # together with the even-odd rule.
+            operands[-1][0].append(polygon)
+            operands[-1] = (operands[-1][0], 'evenodd')
+            continue
+
+        if mode not in (EXCLUDE, SUBTRACT, INTERSECT):
+            mode = UNION
+        if not operands and mode == SUBTRACT:
+            operands.append(([box_polygon(bounds)], 'nonzero'))
+            ops.append(UNION)
+        elif not operands:
+            mode = UNION
+        operands.append(([polygon], 'nonzero'))
+        ops.append(mode)
+
+    if invert:
+        # Flip the shape within the bounds: exclude the box, then cut away
+        # anything left outside it.
+        operands.append(([box_polygon(bounds)], 'nonzero'))
+        ops.append(EXCLUDE)
+        operands.append(([box_polygon(bounds)], 'nonzero'))
+        ops.append(INTERSECT)
+
+    return [loop_segments(loop, curves)
+            for loop in combine_operands(operands, ops)]
@@ -68,10 +68,11 @@ def compute_gradient_offset(bounds, offset):
 
     return (offset_x, offset_y)
 
-def construct_gradient(gradient, bounds, base_color=None):
+def construct_gradient(gradient, bounds, output_format, base_color=None):
     """Construct an <svg:linearGradient> for the given gradient on a layer with
     the given bounds.
     """
+    format_number = output_format.format_number
     assert gradient['Algn'] == True
 
     d_angl = gradient['Angl']
@@ -83,7 +84,8 @@ def construct_gradient(gradient, bounds, base_color=None):
 
     d_clrs = gradient['Grad']['Clrs']
     d_trns = gradient['Grad']['Trns']
-    stops = construct_gradient_stops(d_clrs, d_trns, base_color, gradient['Opct']['value'])
+    stops = construct_gradient_stops(d_clrs, d_trns, base_color,
+            gradient['Opct']['value'], output_format)
 
     assert gradient['Md  ']['type'] == 'BlnM'
     assert gradient['Md  ']['enum'] == 'Nrml'
@@ -92,7 +94,7 @@ def construct_gradient(gradient, bounds, base_color=None):
         stops.reverse()
         for stop in stops:
             offset = float(stop.get('offset'))
-            stop.set('offset', '%f' % (1 - offset))
+            stop.set('offset', output_format.format_fraction(1 - offset))
 
     d_scl = gradient['Scl ']
     assert d_scl['units'] == '#Prc'
@@ -110,10 +112,10 @@ def construct_gradient(gradient, bounds, base_color=None):
         p2['y'] += offset_y
 
         item = etree.Element('{%s}linearGradient' % NS_SVG)
-        item.set('x1', '%f' % p1['x'])
-        item.set('y1', '%f' % p1['y'])
-        item.set('x2', '%f' % p2['x'])
-        item.set('y2', '%f' % p2['y'])
+        item.set('x1', format_number(p1['x']))
+        item.set('y1', format_number(p1['y']))
+        item.set('x2', format_number(p2['x']))
+        item.set('y2', format_number(p2['y']))
         item.set('gradientUnits', 'userSpaceOnUse')
         item.extend(stops)
     elif gradient['Type']['enum'] == 'Rdl ':
@@ -130,9 +132,9 @@ def construct_gradient(gradient, bounds, base_color=None):
         dist = math.sqrt(dx * dx + dy * dy)
 
         item = etree.Element('{%s}radialGradient' % NS_SVG)
-        item.set('cx', '%f' % center['x'])
-        item.set('cy', '%f' % center['y'])
-        item.set('r', '%f' % dist)
+        item.set('cx', format_number(center['x']))
+        item.set('cy', format_number(center['y']))
+        item.set('r', format_number(dist))
         item.set('gradientUnits', 'userSpaceOnUse')
         item.extend(stops)
     else:
@@ -140,7 +142,8 @@ def construct_gradient(gradient, bounds, base_color=None):
 
     return item
 
-def construct_gradient_stops(d_clrs, d_trns, base_color, global_opacity):
+def construct_gradient_stops(d_clrs, d_trns, base_color, global_opacity,
+        output_format):
     """Build <svg:stop>s for each stop in the gradient."""
 
     d_clrs = sorted(d_clrs, key=lambda x: x['Lctn'])
@@ -245,9 +248,81 @@ def construct_gradient_stops(d_clrs, d_trns, base_color, global_opacity):
         pos = lctn_to_pos(lctn)
 
         stop = etree.Element('{%s}stop' % NS_SVG)
-        stop.set('offset', '%f' % pos)
+        stop.set('offset', output_format.format_fraction(pos))
         stop.set('stop-color', parse_color(color))
-        stop.set('stop-opacity', '%f' % opacity)
+        stop.set('stop-opacity', output_format.format_fraction(opacity))
         stops.append(stop)
 
     return stops
+
+
+GRADIENT_TAGS = ('{%s}linearGradient' % NS_SVG, '{%s}radialGradient' % NS_SVG)
+
+class GradientPool(object):
+    """Shares gradients between layers.  The first gradient with a given
+    geometry and stops stays where it was created; later identical
+    gradients are dropped in favor of it.  A later gradient of the same type
+    with the same stops but a different geometry (e.g. an identical
+    gradient on a layer at another position) takes its stops from the first
+    one through xlink:href instead of repeating them.  Gradients that aren't
+    shared are left alone.
+    """
+    def __init__(self):
+        # Maps canonical (tag, geometry, stops) to the id of a gradient.
+        self.gradient_ids = {}
+        # Maps canonical (tag, stops) to the id and attribute names of the
+        # first gradient with those stops.
+        self.stops_owners = {}
+
+    def add(self, gradient):
+        """Add 'gradient' to the pool.  Returns the id of an earlier identical
+        gradient to use in its place, or None if 'gradient' is kept.
+        """
+        stops = tuple(tuple(sorted(stop.items())) for stop in gradient)
+        geometry = tuple(sorted((name, value)
+            for name, value in gradient.items() if name != 'id'))
+
+        key = (gradient.tag, geometry, stops)
+        if key in self.gradient_ids:
+            return self.gradient_ids[key]
+        self.gradient_ids[key] = gradient.get('id')
+
+        if not stops:
+            return None
+        owner = self.stops_owners.get((gradient.tag, stops))
+        if owner is None:
+            self.stops_owners[gradient.tag, stops] = (gradient.get('id'),
+                    frozenset(name for name, value in geometry))
+        elif owner[1] <= frozenset(name for name, value in geometry):
+            # Only the stops are inherited, since this gradient sets every
+            # attribute the owner does.
+            del gradient[:]
+            gradient.set('{%s}href' % NS_XLINK, '#%s' % owner[0])
+        return None
+
+    def intern(self, elements):
+        """Run every gradient in 'elements' (including those nested inside
+        them) through the pool, dropping the duplicates and pointing the
+        references to them at the gradients kept.  Returns the remaining
+        top-level elements, in order.
+        """
+        renamed = {}
+        kept = []
+        for element in elements:
+            if element.tag in GRADIENT_TAGS:
+                pooled_id = self.add(element)
+                if pooled_id is None:
+                    kept.append(element)
+                else:
+                    renamed[element.get('id')] = pooled_id
+                continue
+
+            for gradient in list(element.iter(*GRADIENT_TAGS)):
+                pooled_id = self.add(gradient)
+                if pooled_id is not None:
+                    renamed[gradient.get('id')] = pooled_id
+                    gradient.getparent().remove(gradient)
+            kept.append(element)
+
+        rename_references(kept, renamed)
+        return kept
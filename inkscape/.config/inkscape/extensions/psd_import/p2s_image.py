@@ -0,0 +1,218 @@
+# Copyright (c) 2012 Stuart Pernsteiner
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+from lxml import etree
+import base64
+import errno
+import hashlib
+import os
+import struct
+import tempfile
+import zlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .p2s_util import *
+
+
+PNG_SIGNATURE = '\x89PNG\r\n\x1a\n'
+PNG_IHDR = struct.Struct('>IIBBBBB')    # width, height, bit depth, color type,
+                                        # compression, filter, interlace
+
+def png_chunk(tag, data):
+    crc = zlib.crc32(tag + data) & 0xffffffff
+    return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', crc)
+
+def encode_png(width, height, rgba):
+    """Encode a bytearray of interleaved 8-bit RGBA samples as a PNG.  Rows
+    are fed to the compressor one at a time, without copying the image.
+    """
+    stride = width * 4
+    compressor = zlib.compressobj(6)
+    chunks = []
+    for y in xrange(height):
+        # filter type 0 (none) for each row
+        chunks.append(compressor.compress('\0'))
+        chunks.append(compressor.compress(buffer(rgba, y * stride, stride)))
+    chunks.append(compressor.flush())
+
+    header = PNG_IHDR.pack(width, height, 8, 6, 0, 0, 0)
+    return PNG_SIGNATURE + png_chunk('IHDR', header) + \
+            png_chunk('IDAT', ''.join(chunks)) + png_chunk('IEND', '')
+
+def png_data_uri(png):
+    return 'data:image/png;base64,' + base64.b64encode(png)
+
+def png_href(png, output_format):
+    """Return a reference to the PNG data 'png': a file in the output
+    format's 'image_dir', named after its contents, or else a data URI.
+    """
+    image_dir = output_format.image_dir
+    if image_dir is None:
+        return png_data_uri(png)
+
+    filename = os.path.abspath(os.path.join(image_dir,
+            hashlib.sha1(png).hexdigest()[:16] + '.png'))
+    if not os.path.exists(filename):
+        try:
+            os.makedirs(os.path.dirname(filename))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        # Other processes (split or batch workers) may write the same image
+        # at the same time; rename a complete file into place.
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(filename))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(png)
+        # mkstemp creates files only the owner can read.
+        os.chmod(temp_path, 0o644)
+        os.rename(temp_path, filename)
+
+    if output_format.svg_dir is None:
+        return filename
+    return os.path.relpath(filename,
+            os.path.abspath(output_format.svg_dir)).replace(os.sep, '/')
+
+def crop_rgba(width, rgba, left, top, right, bottom):
+    """Copy the pixels from 'left' to 'right' and 'top' to 'bottom' out of
+    an RGBA bytearray that is 'width' pixels wide.
+    """
+    stride = width * 4
+    return bytearray().join(
+            rgba[y * stride + left * 4:y * stride + right * 4]
+            for y in xrange(top, bottom))
+
+def is_transparent(rgba):
+    alpha = rgba[3::4]
+    return alpha.count('\0') == len(alpha)
+
+def downscale_rgba(width, height, rgba):
+    """Halve the size of an RGBA bytearray, returning (width, height, rgba).
+    With numpy, each pixel is the average of a 2x2 block; without it, every
+    other pixel is kept.
+    """
+    new_width = max(width // 2, 1)
+    new_height = max(height // 2, 1)
+
+    if numpy is not None and width > 1 and height > 1:
+        pixels = numpy.frombuffer(rgba, dtype=numpy.uint8)
+        pixels = pixels.reshape(height, width, 4)[:new_height * 2,
+                :new_width * 2].astype(numpy.uint16)
+        blocks = pixels[0::2, 0::2] + pixels[1::2, 0::2] + \
+                pixels[0::2, 1::2] + pixels[1::2, 1::2]
+        result = ((blocks + 2) // 4).astype(numpy.uint8)
+        return new_width, new_height, bytearray(result.tostring())
+
+    x_step = 2 if width > 1 else 1
+    y_step = 2 if height > 1 else 1
+    stride = width * 4
+    rows = []
+    for y in xrange(0, new_height * y_step, y_step):
+        row = rgba[y * stride:(y + 1) * stride]
+        if x_step == 1:
+            rows.append(row)
+            continue
+        pixels = bytearray(new_width * 4)
+        for component in xrange(4):
+            pixels[component::4] = row[component::8][:new_width]
+        rows.append(pixels)
+    return new_width, new_height, bytearray().join(rows)
+
+def construct_image_element(left, top, width, height, href):
+    # Fixed prefixes: with generated ones, lxml can give the xlink and
+    # inkscape namespaces the same prefix when the element is moved.
+    element = etree.Element('{%s}image' % NS_SVG,
+            nsmap={'xlink': NS_XLINK, 'inkscape': NS_INK})
+    element.set('x', '%d' % left)
+    element.set('y', '%d' % top)
+    element.set('width', '%d' % width)
+    element.set('height', '%d' % height)
+    element.set('preserveAspectRatio', 'none')
+    element.set('{%s}href' % NS_XLINK, href)
+    return element
+
+def construct_tiles(image, rgba, output_format):
+    """Build a group of <image>s, one for each 'tile_size' square of the
+    layer that isn't fully transparent.
+    """
+    tile_size = output_format.tile_size
+    group = etree.Element('{%s}g' % NS_SVG)
+    for top in xrange(0, image.height, tile_size):
+        bottom = min(top + tile_size, image.height)
+        for left in xrange(0, image.width, tile_size):
+            right = min(left + tile_size, image.width)
+            tile = crop_rgba(image.width, rgba, left, top, right, bottom)
+            if is_transparent(tile):
+                continue
+            png = encode_png(right - left, bottom - top, tile)
+            group.append(construct_image_element(image.left + left,
+                image.top + top, right - left, bottom - top,
+                png_href(png, output_format)))
+    return group
+
+def construct_previews(image, rgba, output_format):
+    """Build hidden <image>s covering the layer at 1/2, 1/4, ... of its
+    resolution, up to the output format's 'previews' levels of them.
+    """
+    levels = output_format.previews
+    previews = []
+    width, height = image.width, image.height
+    for level in xrange(1, levels + 1):
+        if width == 1 and height == 1:
+            break
+        width, height, rgba = downscale_rgba(width, height, rgba)
+        element = construct_image_element(image.left, image.top,
+                image.width, image.height,
+                png_href(encode_png(width, height, rgba), output_format))
+        element.set('{%s}label' % NS_INK, 'preview 1:%d' % (1 << level))
+        element.set('display', 'none')
+        previews.append(element)
+    return previews
+
+def construct_image(image, output_format):
+    """Build an element holding the pixels of the LayerImage 'image', or
+    return None if they can't be decoded.  Depending on the output format,
+    this is a single <image>, or a group of tiles and previews.
+    """
+    rgba = image.read()
+    if rgba is None:
+        return None
+
+    if not output_format.tile_size and not output_format.previews:
+        return construct_image_element(image.left, image.top, image.width,
+                image.height, png_href(
+                    encode_png(image.width, image.height, rgba),
+                    output_format))
+
+    if output_format.tile_size:
+        group = construct_tiles(image, rgba, output_format)
+    else:
+        group = etree.Element('{%s}g' % NS_SVG)
+        group.append(construct_image_element(image.left, image.top,
+            image.width, image.height, png_href(
+                encode_png(image.width, image.height, rgba), output_format)))
+    group.extend(construct_previews(image, rgba, output_format))
+    return group
@@ -22,79 +22,232 @@
 # ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 from lxml import etree
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .p2s_boolean import resolve_subpaths
+from .p2s_shapes import construct_shape, recognize_shape
+from .p2s_simplify import EPSILON, end_point, merge_lines, \
+        simplify_segments, subpath_segments
 from .p2s_util import *
 
-def psd_path_records_to_svg_path_data(records, bounds):
-    def render_point(pt):
-        x = bounds['left'] + pt['x'] * (bounds['right'] - bounds['left'])
-        y = bounds['top'] + pt['y'] * (bounds['bottom'] - bounds['top'])
-        return '%f,%f' % (x,y)
+def psd_path_records_to_subpaths(records, bounds):
+    """Group path records into subpaths, scaling the knots to 'bounds'.
+    'records' is either a list of path record dicts or a numpy array from
+    'PSDReader.read_path_array'.  Each subpath is a dict with its
+    'combine_mode', whether it is 'closed', and its 'knots', one row of
+    (back x, back y, anchor x, anchor y, front x, front y) per knot.
+    """
+    if numpy is not None and isinstance(records, numpy.ndarray):
+        return psd_path_array_to_subpaths(records, bounds)
 
-    render_points = lambda *pts: tuple(map(render_point, pts))
+    left = bounds['left']
+    top = bounds['top']
+    width = bounds['right'] - bounds['left']
+    height = bounds['bottom'] - bounds['top']
 
-    d = ''
-    results = []
+    def scale(pt):
+        return (left + pt['x'] * width, top + pt['y'] * height)
 
-    # Current subpath mode ('open' or 'closed')
-    path_mode = None
-    # Current subpath combine mode (1 = normal, 2 = subtract)
-    combine_mode = None
-
-    # The back-facing handle and anchor positions for the subpath's first knot
-    first_back = None
-    first_anchor = None
-    # The front-facing handle position for the previous knot
-    prev_front = None
-
-    def finish_path():
-        # Finish the current path and append its data to 'results'.
-        if first_back is None:
-            return
-
-        if path_mode == 'closed':
-            # Add a segment from the final anchor point to the initial one.
-            extra_d = 'C %s %s %s Z' % render_points(
-                    prev_front, first_back, first_anchor)
-        else:
-            extra_d = ''
-
-        path = {}
-        path['combine_mode'] = combine_mode
-        path['data'] = d + extra_d
-        results.append(path)
+    results = []
+    # Knots that appear before the first subpath record still form a
+    # (modeless) subpath of their own.
+    subpath = {'combine_mode': None, 'closed': False, 'knots': []}
 
     for record in records:
         if record['type'] == 'subpath_start':
-            # Finish the active subpath
-            finish_path()
+            if subpath['knots']:
+                results.append(subpath)
+            subpath = {
+                'combine_mode': record['combine_mode'],
+                'closed': record['mode'] == 'closed',
+                'knots': [],
+            }
+        elif record['type'] == 'knot':
+            subpath['knots'].append(scale(record['control_back']) +
+                    scale(record['control_anchor']) +
+                    scale(record['control_front']))
 
-            # Reinitialize for the next subpath
-            d = ''
-            path_mode = record['mode']
-            combine_mode = record['combine_mode']
-            first_back = None
-            first_anchor = None
-            prev_front = None
+    if subpath['knots']:
+        results.append(subpath)
 
-        elif record['type'] == 'knot':
-            if prev_front is None:
-                # This is the first point of the path
-                first_back = record['control_back']
-                first_anchor = record['control_anchor']
-                d += 'M %s ' % render_point(record['control_anchor'])
-                prev_front = record['control_front']
-            else:
-                d += 'C %s %s %s ' % render_points(
-                        prev_front,
-                        record['control_back'],
-                        record['control_anchor'])
-                prev_front = record['control_front']
-
-    # Finish the final subpath
-    finish_path()
+    return results
+
+def psd_path_array_to_subpaths(records, bounds):
+    types = records['type']
+    is_knot = (types == 1) | (types == 2) | (types == 4) | (types == 5)
+    starts = numpy.flatnonzero((types == 0) | (types == 3))
+
+    # Scale all of the control points to the layer bounds at once.
+    points = records['points'].reshape(-1, 6)
+    knots = numpy.empty_like(points)
+    knots[:, 0::2] = bounds['left'] + \
+            points[:, 0::2] * (bounds['right'] - bounds['left'])
+    knots[:, 1::2] = bounds['top'] + \
+            points[:, 1::2] * (bounds['bottom'] - bounds['top'])
+
+    spans = [(None, False, 0)] if len(starts) == 0 or starts[0] > 0 else []
+    spans.extend((int(records['combine_mode'][i]), types[i] == 0, i + 1)
+            for i in starts)
+
+    results = []
+    for n, (combine_mode, closed, begin) in enumerate(spans):
+        end = spans[n + 1][2] - 1 if n + 1 < len(spans) else len(records)
+        subpath_knots = knots[begin:end][is_knot[begin:end]]
+        if len(subpath_knots) == 0:
+            continue
+        results.append({
+            'combine_mode': combine_mode,
+            'closed': bool(closed),
+            'knots': subpath_knots,
+        })
 
     return results
 
+def psd_path_records_bounds(records, bounds):
+    """Return the bounding box of the control points of a vector mask's
+    path records (which contains the path itself), or None if there are no
+    knots.
+    """
+    xs = []
+    ys = []
+    for subpath in psd_path_records_to_subpaths(records, bounds):
+        for knot in subpath['knots']:
+            xs.extend(knot[0::2])
+            ys.extend(knot[1::2])
+    if not xs:
+        return None
+    return {'left': min(xs), 'top': min(ys),
+            'right': max(xs), 'bottom': max(ys)}
+
+def join_numbers(numbers):
+    """Join formatted numbers, leaving out the separator where a minus sign
+    already separates two numbers.
+    """
+    parts = []
+    for number in numbers:
+        if parts and not number.startswith('-'):
+            parts.append(' ')
+        parts.append(number)
+    return ''.join(parts)
+
+def compact_subpath_to_svg_path_data(start, segments, closed, output_format):
+    """Render a subpath with the shortest of absolute and relative commands
+    for each segment, leaving out repeated command letters.  'segments' is
+    a list of ('L', (x, y)) and ('C', (x1, y1, x2, y2, x, y)) pairs.
+    """
+    # Round the absolute positions first, so relative offsets computed from
+    # them don't accumulate rounding errors.
+    round_number = output_format.round_number
+    format_number = output_format.format_number
+    start = [round_number(v) for v in start]
+
+    d = ['M' + join_numbers([format_number(v) for v in start])]
+    x, y = start
+    prev_command = None
+    for command, seg in segments:
+        seg = [round_number(v) for v in seg]
+        absolute = join_numbers([format_number(v) for v in seg])
+        relative = join_numbers([format_number(v - (x, y)[j % 2])
+            for j, v in enumerate(seg)])
+
+        if len(relative) < len(absolute):
+            command, text = command.lower(), relative
+        else:
+            text = absolute
+
+        if command == prev_command and not text.startswith('-'):
+            d.append(' ')
+        elif command != prev_command:
+            d.append(command)
+        d.append(text)
+
+        prev_command = command
+        x, y = seg[-2], seg[-1]
+
+    if closed:
+        d.append('z')
+    return ''.join(d)
+
+def segments_to_svg_path_data(start, segments, closed, output_format):
+    """Render a subpath given as a start point and a list of segments (see
+    'compact_subpath_to_svg_path_data') as SVG path data.
+    """
+    if output_format.compact:
+        return compact_subpath_to_svg_path_data(start, segments, closed,
+                output_format)
+
+    parts = ['M %s' % output_format.format_point(*start)]
+    for command, coords in segments:
+        parts.append(command)
+        parts.extend(output_format.format_point(coords[i], coords[i + 1])
+                for i in xrange(0, len(coords), 2))
+    if closed:
+        parts.append('Z')
+    return ' '.join(parts)
+
+def subpath_to_svg_path_data(subpath, output_format):
+    """Render a subpath from 'psd_path_records_to_subpaths' as SVG path data.
+    The whole subpath is formatted with a single string operation.
+    """
+    if output_format.simplify:
+        start, segments = subpath_segments(subpath)
+        segments = simplify_segments(start, segments, subpath['closed'],
+                output_format.fit_tolerance)
+        return segments_to_svg_path_data(start, segments, subpath['closed'],
+                output_format)
+
+    knots = subpath['knots']
+    count = len(knots)
+
+    # Each segment runs from the previous knot's anchor, via its front handle
+    # and the next knot's back handle, to the next knot's anchor.
+    if numpy is not None and isinstance(knots, numpy.ndarray):
+        coords = knots[0, 2:4].tolist()
+        coords.extend(numpy.hstack((knots[:-1, 4:6], knots[1:, 0:4]))
+                .ravel().tolist())
+        if subpath['closed']:
+            coords.extend(knots[-1, 4:6].tolist())
+            coords.extend(knots[0, 0:4].tolist())
+    else:
+        coords = list(knots[0][2:4])
+        for prev, cur in zip(knots[:-1], knots[1:]):
+            coords.extend(prev[4:6])
+            coords.extend(cur[0:4])
+        if subpath['closed']:
+            coords.extend(knots[-1][4:6])
+            coords.extend(knots[0][0:4])
+
+    if output_format.compact:
+        return compact_subpath_to_svg_path_data(coords[:2],
+                [('C', coords[i:i + 6]) for i in xrange(2, len(coords), 6)],
+                subpath['closed'], output_format)
+
+    template = 'M %f,%f ' + 'C %f,%f %f,%f %f,%f ' * (count - 1)
+    if subpath['closed']:
+        # Add a segment from the final anchor point to the initial one.
+        template += 'C %f,%f %f,%f %f,%f Z'
+
+    if not output_format.plain():
+        return template.replace('%f', '%s') % \
+                tuple(output_format.format_number(v) for v in coords)
+    return template % tuple(coords)
+
+def psd_path_records_to_svg_path_data(records, bounds, output_format):
+    return subpaths_to_svg_path_data(
+            psd_path_records_to_subpaths(records, bounds), output_format)
+
+def subpaths_to_svg_path_data(subpaths, output_format):
+    results = []
+    for subpath in subpaths:
+        path = {}
+        path['combine_mode'] = subpath['combine_mode']
+        path['data'] = subpath_to_svg_path_data(subpath, output_format)
+        results.append(path)
+    return results
+
 def build_path_from_data(path_data, invert, bounds):
     """Build a <svg:path> from the results of
     'psd_path_records_to_svg_path_data'.  Returns a <path> and possibly a
@@ -187,11 +340,41 @@ def build_path_from_data(path_data, invert, bounds):
 
     return path, mask
 
-def construct_path(records, flags, bounds):
+def build_combined_path(subpaths, invert, bounds, output_format):
+    """Build a single <svg:path> for 'subpaths', resolving their combine
+    modes with p2s_boolean.  Curves cut by another subpath are flattened
+    into lines.
+    """
+    data = []
+    for start, segments in resolve_subpaths(subpaths, invert, bounds):
+        segments = merge_lines(start, segments, EPSILON)
+        if segments and segments[-1][0] == 'L' \
+                and end_point(segments[-1]) == start:
+            segments.pop()
+        data.append(segments_to_svg_path_data(start, segments, True,
+            output_format))
+
+    path = etree.Element('{%s}path' % NS_SVG)
+    path.set('d', ' '.join(data))
+    path.set('fill-rule', 'nonzero')
+    return path
+
+def construct_path(records, flags, bounds, output_format):
     if flags & 4 != 0:
         # Vector mask is disabled.
         data = []
     else:
-        data = psd_path_records_to_svg_path_data(records,  bounds)
+        subpaths = psd_path_records_to_subpaths(records, bounds)
+        invert = flags & 1 != 0
+        if output_format.boolean and subpaths and (invert
+                or len(subpaths) > 1 or subpaths[0]['combine_mode'] == 2):
+            return build_combined_path(subpaths, invert, bounds,
+                    output_format), None
+        if output_format.shapes and not invert and len(subpaths) == 1 \
+                and subpaths[0]['combine_mode'] != 2:
+            shape = recognize_shape(subpaths[0])
+            if shape is not None:
+                return construct_shape(shape, output_format), None
+        data = subpaths_to_svg_path_data(subpaths, output_format)
 
     return build_path_from_data(data, (flags & 1 != 0), bounds)
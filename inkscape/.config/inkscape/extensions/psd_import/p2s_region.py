@@ -0,0 +1,104 @@
+# Copyright (c) 2012 Stuart Pernsteiner
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""Region selection: a grid index over layer extents, so that only the
+layers that intersect a region of the canvas are converted.
+
+Boxes are bounds dicts ('left', 'top', 'right', 'bottom'), like the layer
+and image bounds read from the PSD.
+"""
+
+# The grid has at most this many cells along each side.
+MAX_GRID_CELLS = 64
+
+def parse_region(text):
+    """Parse an 'x,y,w,h' string into bounds.  Raises ValueError if it is
+    malformed or the region is empty.
+    """
+    parts = text.split(',')
+    if len(parts) != 4:
+        raise ValueError('expected x,y,w,h, got %r' % text)
+    x, y, w, h = [float(part) for part in parts]
+    if w <= 0 or h <= 0:
+        raise ValueError('region %r is empty' % text)
+    return {'left': x, 'top': y, 'right': x + w, 'bottom': y + h}
+
+def is_empty(box):
+    return box['left'] >= box['right'] or box['top'] >= box['bottom']
+
+def intersects(a, b):
+    return a['left'] < b['right'] and b['left'] < a['right'] \
+            and a['top'] < b['bottom'] and b['top'] < a['bottom']
+
+def union(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return {
+        'left': min(a['left'], b['left']),
+        'top': min(a['top'], b['top']),
+        'right': max(a['right'], b['right']),
+        'bottom': max(a['bottom'], b['bottom']),
+    }
+
+class GridIndex(object):
+    """A uniform grid over 'bounds' (normally the canvas), mapping each cell
+    to the keys whose boxes overlap it.  Boxes reaching outside 'bounds'
+    are clamped into the edge cells, so they are still found.
+    """
+    def __init__(self, bounds):
+        self.left = bounds['left']
+        self.top = bounds['top']
+        width = max(bounds['right'] - self.left, 1)
+        height = max(bounds['bottom'] - self.top, 1)
+        self.cell_size = float(max(width, height)) / MAX_GRID_CELLS
+        self.columns = int(width / self.cell_size) + 1
+        self.rows = int(height / self.cell_size) + 1
+        self.cells = {}
+        self.boxes = {}
+
+    def cell_range(self, box):
+        def clamp(value, count):
+            return min(max(int(value / self.cell_size), 0), count - 1)
+        return (clamp(box['left'] - self.left, self.columns),
+                clamp(box['top'] - self.top, self.rows),
+                clamp(box['right'] - self.left, self.columns),
+                clamp(box['bottom'] - self.top, self.rows))
+
+    def insert(self, key, box):
+        self.boxes[key] = box
+        left, top, right, bottom = self.cell_range(box)
+        for row in xrange(top, bottom + 1):
+            for column in xrange(left, right + 1):
+                self.cells.setdefault((column, row), []).append(key)
+
+    def query(self, box):
+        """Return the set of keys whose boxes intersect 'box'."""
+        result = set()
+        left, top, right, bottom = self.cell_range(box)
+        for row in xrange(top, bottom + 1):
+            for column in xrange(left, right + 1):
+                for key in self.cells.get((column, row), ()):
+                    if key not in result and intersects(self.boxes[key], box):
+                        result.add(key)
+        return result
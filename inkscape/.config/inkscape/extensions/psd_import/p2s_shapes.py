@@ -0,0 +1,142 @@
+# Copyright (c) 2012 Stuart Pernsteiner
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""Recognize subpaths that are really rectangles, rounded rectangles or
+ellipses, so they can be written as <rect> and <ellipse> elements.
+"""
+from lxml import etree
+import math
+
+from .p2s_simplify import bezier_point, subpath_segments
+from .p2s_util import *
+
+
+# Points sampled on each segment of a subpath.
+SHAPE_SAMPLES = 16
+
+def sample_subpath(subpath):
+    start, segments = subpath_segments(subpath)
+    points = [start]
+    pos = start
+    for command, coords in segments:
+        points.extend(bezier_point(pos, coords[0:2], coords[2:4], coords[4:6],
+            i / float(SHAPE_SAMPLES)) for i in xrange(1, SHAPE_SAMPLES + 1))
+        pos = coords[4:6]
+    return points
+
+def polygon_area(points):
+    area = 0.0
+    for a, b in zip(points, points[1:] + points[:1]):
+        area += a[0] * b[1] - b[0] * a[1]
+    return abs(area) / 2
+
+def outline_distance(point, shape):
+    """Distance from 'point' to the outline of a rounded rectangle (which
+    may have zero or full-size corner radii).
+    """
+    cx, cy, half_width, half_height, rx, ry = shape
+    qx = abs(point[0] - cx)
+    qy = abs(point[1] - cy)
+    inner_x = half_width - rx
+    inner_y = half_height - ry
+    if qx > inner_x and qy > inner_y and rx > 0 and ry > 0:
+        # In a corner: measure against the corner's ellipse.  The radial
+        # error is a good estimate of the distance for nearby points.
+        dx = (qx - inner_x) / rx
+        dy = (qy - inner_y) / ry
+        return abs(math.hypot(dx, dy) - 1) * min(rx, ry)
+    return abs(max(qx - half_width, qy - half_height))
+
+def corner_radius(points, edge, along, tolerance):
+    """Estimate a corner radius from where the outline leaves a straight
+    edge: 'edge' picks the coordinate that is constant along it, 'along'
+    the one that varies.
+    """
+    edge_value = min(p[edge] for p in points)
+    on_edge = [p[along] for p in points if p[edge] - edge_value <= tolerance]
+    low = min(p[along] for p in points)
+    return max(min(on_edge) - low, 0.0)
+
+def recognize_shape(subpath):
+    """Return the rectangle ('rect', x, y, width, height, rx, ry) or ellipse
+    ('ellipse', cx, cy, rx, ry) that 'subpath' draws, or None if it is some
+    other shape.
+    """
+    if not subpath['closed'] or len(subpath['knots']) < 2:
+        return None
+
+    points = sample_subpath(subpath)
+    left = min(p[0] for p in points)
+    right = max(p[0] for p in points)
+    top = min(p[1] for p in points)
+    bottom = max(p[1] for p in points)
+    width = right - left
+    height = bottom - top
+    if width <= 0 or height <= 0:
+        return None
+
+    # Bezier arcs are only approximately elliptical.
+    tolerance = 0.01 + 0.001 * max(width, height)
+
+    # Points on the straight edges are exact, so they can be found with a
+    # much tighter tolerance.
+    edge_tolerance = 1e-6 * (1 + max(width, height))
+    rx = corner_radius(points, 1, 0, edge_tolerance)
+    ry = corner_radius(points, 0, 1, edge_tolerance)
+    # Snap nearly-full or nearly-zero radii.
+    if rx >= width / 2 - tolerance and ry >= height / 2 - tolerance:
+        rx, ry = width / 2, height / 2
+    elif rx <= tolerance or ry <= tolerance:
+        rx = ry = 0.0
+
+    shape = (left + width / 2, top + height / 2, width / 2, height / 2,
+            rx, ry)
+    if any(outline_distance(p, shape) > tolerance for p in points):
+        return None
+
+    expected_area = width * height - (4 - math.pi) * rx * ry
+    if abs(polygon_area(points) - expected_area) > 0.01 * expected_area:
+        return None
+
+    if rx == width / 2 and ry == height / 2:
+        return ('ellipse', left + rx, top + ry, rx, ry)
+    return ('rect', left, top, width, height, rx, ry)
+
+def construct_shape(shape, output_format):
+    """Build a <rect> or <ellipse> for a shape from 'recognize_shape'."""
+    if shape[0] == 'ellipse':
+        names = ('cx', 'cy', 'rx', 'ry')
+    else:
+        names = ('x', 'y', 'width', 'height', 'rx', 'ry')
+
+    element = etree.Element('{%s}%s' % (NS_SVG, shape[0]))
+    for name, value in zip(names, shape[1:]):
+        if name in ('rx', 'ry') and value == 0:
+            continue
+        element.set(name, output_format.format_number(value))
+    return element
+
+def construct_box(bounds, output_format):
+    """Build a <rect> covering 'bounds'."""
+    return construct_shape(('rect', bounds['left'], bounds['top'],
+        bounds['right'] - bounds['left'], bounds['bottom'] - bounds['top'],
+        0, 0), output_format)
@@ -0,0 +1,301 @@
+# Copyright (c) 2012 Stuart Pernsteiner
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""Geometry cleanup for subpaths before they are written out.
+
+A subpath is handled as a start point and a list of segments, each either
+('L', (x, y)) or ('C', (x1, y1, x2, y2, x, y)).
+"""
+import math
+
+
+# Distances (in pixels) below this are treated as zero.
+EPSILON = 1e-4
+
+# Points sampled on each original curve when checking a refitted one.
+FIT_SAMPLES = 8
+
+# Largest sine of the angle between the tangents at a join for the join to
+# count as smooth.
+SMOOTH_TOLERANCE = 0.01
+
+def subpath_segments(subpath):
+    """Return the start point and segments of a subpath from
+    'psd_path_records_to_subpaths'.  Every segment is a cubic; a closed
+    subpath gets one more, back to its first knot.
+    """
+    knots = [tuple(knot) for knot in subpath['knots']]
+    start = knots[0][2:4]
+    pairs = zip(knots[:-1], knots[1:])
+    if subpath['closed']:
+        pairs.append((knots[-1], knots[0]))
+    segments = [('C', prev[4:6] + cur[0:4]) for prev, cur in pairs]
+    return start, segments
+
+def distance(a, b):
+    return math.hypot(b[0] - a[0], b[1] - a[1])
+
+def distance_to_line(p, a, b):
+    """Distance from 'p' to the line through 'a' and 'b', or to 'a' if the
+    two coincide.
+    """
+    length = distance(a, b)
+    if length < EPSILON:
+        return distance(p, a)
+    return abs((b[0] - a[0]) * (p[1] - a[1]) -
+            (b[1] - a[1]) * (p[0] - a[0])) / length
+
+def on_segment(p, a, b, tolerance):
+    """Return True if 'p' lies within 'tolerance' of the line segment from
+    'a' to 'b'.
+    """
+    if distance_to_line(p, a, b) > tolerance:
+        return False
+    dx, dy = b[0] - a[0], b[1] - a[1]
+    t = (p[0] - a[0]) * dx + (p[1] - a[1]) * dy
+    length2 = dx * dx + dy * dy
+    return -tolerance * math.sqrt(length2) <= t <= \
+            length2 + tolerance * math.sqrt(length2)
+
+def end_point(segment):
+    return segment[1][-2:]
+
+def straighten(start, segments, tolerance):
+    """Turn cubics whose control points lie on their chord into lines, and
+    drop segments of zero length.
+    """
+    result = []
+    pos = start
+    for command, coords in segments:
+        end = coords[-2:]
+        if command == 'C':
+            c1, c2 = coords[0:2], coords[2:4]
+            if on_segment(c1, pos, end, tolerance) \
+                    and on_segment(c2, pos, end, tolerance):
+                command, coords = 'L', end
+        if command == 'L' and distance(pos, end) < EPSILON:
+            continue
+        result.append((command, coords))
+        pos = end
+    return result
+
+def merge_lines(start, segments, tolerance):
+    """Merge runs of lines that continue in the same direction.  A run is
+    only extended if every vertex it replaces stays within 'tolerance' of
+    the new line, so the error can't build up along the run.
+    """
+    result = []
+    pos = start
+    run_start = None
+    run_points = []
+    for command, coords in segments:
+        if command == 'L' and result and result[-1][0] == 'L' \
+                and all(on_segment(p, run_start, coords, tolerance)
+                        for p in run_points):
+            result[-1] = ('L', coords)
+            run_points.append(coords)
+        else:
+            run_start = pos
+            run_points = [coords]
+            result.append((command, coords))
+        pos = coords[-2:]
+    return result
+
+def bezier_point(p0, p1, p2, p3, t):
+    s = 1 - t
+    a, b, c, d = s * s * s, 3 * s * s * t, 3 * s * t * t, t * t * t
+    return (a * p0[0] + b * p1[0] + c * p2[0] + d * p3[0],
+            a * p0[1] + b * p1[1] + c * p2[1] + d * p3[1])
+
+def unit(v):
+    length = math.hypot(v[0], v[1])
+    if length < EPSILON:
+        return None
+    return (v[0] / length, v[1] / length)
+
+def start_tangent(p0, p1, p2, p3):
+    for q in (p1, p2, p3):
+        tangent = unit((q[0] - p0[0], q[1] - p0[1]))
+        if tangent is not None:
+            return tangent
+    return None
+
+def end_tangent(p0, p1, p2, p3):
+    return start_tangent(p3, p2, p1, p0)
+
+def fit_cubic(points, p0, p3, t0, t3, tolerance):
+    """Fit one cubic from 'p0' to 'p3', leaving along 't0' and arriving
+    along 't3' (unit vectors pointing into the curve at each end), to the
+    sample 'points'.  Only the lengths of the two handles are solved for,
+    by least squares over a chord-length parameterization.  Returns the
+    control points, or None if the curve strays more than 'tolerance' from
+    any sample.
+    """
+    lengths = [0.0]
+    for a, b in zip(points[:-1], points[1:]):
+        lengths.append(lengths[-1] + distance(a, b))
+    if lengths[-1] < EPSILON:
+        return None
+    params = [l / lengths[-1] for l in lengths]
+
+    c11 = c12 = c22 = x1 = x2 = 0.0
+    for p, t in zip(points, params):
+        s = 1 - t
+        b0, b1, b2, b3 = s * s * s, 3 * s * s * t, 3 * s * t * t, t * t * t
+        a1 = (t0[0] * b1, t0[1] * b1)
+        a2 = (t3[0] * b2, t3[1] * b2)
+        rest = (p[0] - p0[0] * (b0 + b1) - p3[0] * (b2 + b3),
+                p[1] - p0[1] * (b0 + b1) - p3[1] * (b2 + b3))
+        c11 += a1[0] * a1[0] + a1[1] * a1[1]
+        c12 += a1[0] * a2[0] + a1[1] * a2[1]
+        c22 += a2[0] * a2[0] + a2[1] * a2[1]
+        x1 += rest[0] * a1[0] + rest[1] * a1[1]
+        x2 += rest[0] * a2[0] + rest[1] * a2[1]
+
+    det = c11 * c22 - c12 * c12
+    if abs(det) < 1e-12:
+        return None
+    alpha1 = (x1 * c22 - x2 * c12) / det
+    alpha2 = (c11 * x2 - c12 * x1) / det
+    if alpha1 <= EPSILON or alpha2 <= EPSILON:
+        return None
+
+    p1 = (p0[0] + t0[0] * alpha1, p0[1] + t0[1] * alpha1)
+    p2 = (p3[0] + t3[0] * alpha2, p3[1] + t3[1] * alpha2)
+
+    for p, t in zip(points, params):
+        t = nearest_param(p0, p1, p2, p3, p, t)
+        if distance(p, bezier_point(p0, p1, p2, p3, t)) > tolerance:
+            return None
+    return p1, p2
+
+def nearest_param(p0, p1, p2, p3, p, t, iterations=3):
+    """Refine 't' towards the parameter of the point on the cubic closest
+    to 'p', with a few Newton steps.
+    """
+    for i in xrange(iterations):
+        s = 1 - t
+        point = bezier_point(p0, p1, p2, p3, t)
+        d1 = [3 * (s * s * (p1[k] - p0[k]) + 2 * s * t * (p2[k] - p1[k]) +
+                t * t * (p3[k] - p2[k])) for k in (0, 1)]
+        d2 = [6 * (s * (p2[k] - 2 * p1[k] + p0[k]) +
+                t * (p3[k] - 2 * p2[k] + p1[k])) for k in (0, 1)]
+        diff = [point[k] - p[k] for k in (0, 1)]
+        numerator = diff[0] * d1[0] + diff[1] * d1[1]
+        denominator = d1[0] * d1[0] + d1[1] * d1[1] + \
+                diff[0] * d2[0] + diff[1] * d2[1]
+        if abs(denominator) < 1e-12:
+            break
+        t = min(max(t - numerator / denominator, 0.0), 1.0)
+    return t
+
+def sample_cubics(start, cubics):
+    points = [start]
+    pos = start
+    for coords in cubics:
+        c1, c2, end = coords[0:2], coords[2:4], coords[4:6]
+        points.extend(bezier_point(pos, c1, c2, end, i / float(FIT_SAMPLES))
+                for i in xrange(1, FIT_SAMPLES + 1))
+        pos = end
+    return points
+
+def smooth_join(prev_start, prev, cur_start, cur):
+    """Return True if two consecutive cubics meet without a corner."""
+    incoming = end_tangent(prev_start, prev[0:2], prev[2:4], prev[4:6])
+    outgoing = start_tangent(cur_start, cur[0:2], cur[2:4], cur[4:6])
+    if incoming is None or outgoing is None:
+        return False
+    # 'incoming' points back along the previous curve.
+    cross = incoming[0] * outgoing[1] - incoming[1] * outgoing[0]
+    dot = incoming[0] * outgoing[0] + incoming[1] * outgoing[1]
+    return dot < 0 and abs(cross) <= SMOOTH_TOLERANCE
+
+def extend_run(run, pos, coords, tolerance):
+    """Try to add the cubic 'coords', starting at 'pos', to a run of cubics
+    that are being replaced by one.  Returns the extended run, or None.
+    """
+    if not smooth_join(run['last_start'], run['cubics'][-1], pos, coords):
+        return None
+
+    first = run['cubics'][0]
+    t0 = start_tangent(run['start'], first[0:2], first[2:4], first[4:6])
+    t3 = end_tangent(pos, coords[0:2], coords[2:4], coords[4:6])
+    if t0 is None or t3 is None:
+        return None
+
+    cubics = run['cubics'] + [coords]
+    handles = fit_cubic(sample_cubics(run['start'], cubics), run['start'],
+            coords[4:6], t0, t3, tolerance)
+    if handles is None:
+        return None
+    return {
+        'start': run['start'],
+        'cubics': cubics,
+        'last_start': pos,
+        'fitted': handles[0] + handles[1] + coords[4:6],
+    }
+
+def refit_curves(start, segments, tolerance):
+    """Replace runs of smoothly joined cubics with single cubics wherever
+    the result stays within 'tolerance' of the original curves.
+    """
+    result = []
+    pos = start
+    run = None
+
+    for command, coords in segments:
+        if command == 'C' and run is not None:
+            extended = extend_run(run, pos, coords, tolerance)
+            if extended is not None:
+                run = extended
+                pos = coords[4:6]
+                continue
+
+        if run is not None:
+            result.append(('C', run['fitted']))
+            run = None
+        if command == 'C':
+            run = {'start': pos, 'cubics': [coords], 'last_start': pos,
+                    'fitted': coords}
+        else:
+            result.append((command, coords))
+        pos = coords[-2:]
+
+    if run is not None:
+        result.append(('C', run['fitted']))
+    return result
+
+def simplify_segments(start, segments, closed, tolerance=None):
+    """Clean up the segments of a subpath: collapse straight cubics to
+    lines, drop zero-length segments, merge collinear lines and, if a
+    'tolerance' is given, refit runs of curves.  A closed subpath's final
+    line back to the start is dropped, since 'Z' draws it.
+    """
+    line_tolerance = max(tolerance or 0, EPSILON)
+    segments = straighten(start, segments, line_tolerance)
+    segments = merge_lines(start, segments, line_tolerance)
+    if tolerance:
+        segments = refit_curves(start, segments, tolerance)
+    if closed and segments and segments[-1][0] == 'L' \
+            and distance(end_point(segments[-1]), start) < EPSILON:
+        segments.pop()
+    return segments
@@ -22,6 +22,10 @@
 # ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 NS_SVG = 'http://www.w3.org/2000/svg'
 NS_INK = 'http://www.inkscape.org/namespaces/inkscape'
+NS_XLINK = 'http://www.w3.org/1999/xlink'
+
+import math
+import re
 
 _last_id = 0
 def next_id():
@@ -29,6 +33,51 @@ def next_id():
     _last_id += 1
     return '_%d' % _last_id
 
+def reset_ids():
+    """Start numbering generated ids from the beginning again, for converting
+    another document in the same process.
+    """
+    global _last_id
+    _last_id = 0
+
+GENERATED_ID = re.compile(r'^_\d+$')
+
+def renumber_ids(elements):
+    """Give fresh ids (from 'next_id') to every element under 'elements'
+    that has a generated id, and update the references to them.  Used for
+    fragments that were generated earlier, whose ids may clash with ones in
+    use now.
+    """
+    renamed = {}
+    for element in elements:
+        for child in element.iter():
+            old_id = child.get('id')
+            if old_id is not None and GENERATED_ID.match(old_id):
+                new_id = next_id()
+                renamed[old_id] = new_id
+                child.set('id', new_id)
+
+    rename_references(elements, renamed)
+
+REFERENCE = re.compile(r'#(_\d+)\b')
+
+def rename_references(elements, renamed):
+    """Update references ('url(#_1)', '#_1') to generated ids in the
+    attributes of every element under 'elements'.  'renamed' maps old ids to
+    new ones.
+    """
+    if not renamed:
+        return
+
+    def replace(match):
+        return '#' + renamed.get(match.group(1), match.group(1))
+
+    for element in elements:
+        for child in element.iter():
+            for name, value in child.items():
+                if '#_' in value:
+                    child.set(name, REFERENCE.sub(replace, value))
+
 def parse_color(color_desc):
     r = int(color_desc['Rd  '])
     g = int(color_desc['Grn '])
@@ -38,3 +87,108 @@ def parse_color(color_desc):
 def box_path_data(bounds):
     return 'M %(left)d,%(top)d %(right)d,%(top)d %(right)d,%(bottom)d ' \
             '%(left)d,%(bottom)d %(left)d,%(top)d Z' % bounds
+
+
+# Decimal places kept for opacities and stop offsets, however low the
+# precision for coordinates is.  Gradient stop locations have 4096 steps.
+FRACTION_DIGITS = 4
+
+class OutputFormat(object):
+    """Options controlling how the SVG is written, passed down through the
+    conversion.
+
+    By default every number is written with '%f'.  'precision' limits the
+    number of decimal places, 'snap' rounds values to a grid of that size
+    (e.g. 1 for whole device pixels), and 'compact' enables the shorter path
+    syntax written by 'p2s_path'.  Once either of the first two is set,
+    trailing zeros are trimmed as well.
+
+    'simplify' and 'fit_tolerance' clean up subpaths (see p2s_simplify),
+    'shapes' writes rectangles and ellipses as <rect> and <ellipse>
+    elements, and 'boolean' combines subtractive and mixed subpaths into one
+    path (see p2s_boolean) instead of drawing them through a <mask>.
+
+    'images' converts pixel layers to <image>s, split into tiles of
+    'tile_size' pixels and with 'previews' levels of half-resolution copies
+    if those are set.  With 'image_dir', the PNGs are written there instead
+    of being embedded (see p2s_image), and referred to relative to
+    'svg_dir', the directory the SVG is written to, or by their absolute
+    path if that isn't known.
+    """
+    def __init__(self, precision=None, snap=None, compact=False, images=True,
+            tile_size=None, image_dir=None, previews=0, simplify=False,
+            fit_tolerance=None, shapes=False, boolean=False, svg_dir=None):
+        self.precision = precision
+        self.snap = snap
+        self.compact = compact
+        self.images = images
+        self.tile_size = tile_size
+        self.image_dir = image_dir
+        self.previews = previews
+        self.simplify = simplify
+        self.fit_tolerance = fit_tolerance
+        self.shapes = shapes
+        self.boolean = boolean
+        self.svg_dir = svg_dir
+
+    def replace(self, **options):
+        """Return a copy of this format with some options changed."""
+        result = OutputFormat(**self.__dict__)
+        result.__dict__.update(options)
+        return result
+
+    def key(self):
+        """Return the options as a sorted list of pairs, for cache keys."""
+        options = dict(self.__dict__)
+        if self.image_dir is None:
+            # Only image hrefs depend on where the SVG goes.
+            del options['svg_dir']
+        return sorted(options.items())
+
+    def plain(self):
+        """Return True if numbers are written with the default '%f'
+        format.
+        """
+        return self.precision is None and not self.snap and not self.compact
+
+    def round_number(self, value):
+        """Round 'value' to the output precision and grid, if any."""
+        if self.snap:
+            value = math.floor(value / self.snap + 0.5) * self.snap
+        if self.precision is not None:
+            value = round(value, self.precision)
+        return value
+
+    def format_number(self, value):
+        if self.plain():
+            return '%f' % value
+
+        precision = self.precision
+        if precision is None:
+            precision = 6
+        result = '%.*f' % (precision, self.round_number(value))
+        if '.' in result:
+            result = result.rstrip('0').rstrip('.')
+        if result == '-0':
+            result = '0'
+        return result
+
+    def format_fraction(self, value):
+        """Format a value between 0 and 1, like an opacity or a gradient stop
+        offset.  These aren't coordinates, so they are never snapped, and
+        keep at least FRACTION_DIGITS decimal places.
+        """
+        if self.plain():
+            return '%f' % value
+
+        precision = max(self.precision, FRACTION_DIGITS) \
+                if self.precision is not None else 6
+        result = ('%.*f' % (precision, value)).rstrip('0').rstrip('.')
+        if result == '-0':
+            result = '0'
+        return result
+
+    def format_point(self, x, y):
+        return '%s,%s' % (self.format_number(x), self.format_number(y))
+
+DEFAULT_OUTPUT_FORMAT = OutputFormat()
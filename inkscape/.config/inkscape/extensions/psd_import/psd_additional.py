@@ -20,7 +20,14 @@
 # WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
 # OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
 # ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
-from .binaryreader import BinaryReader
+import struct
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .binaryreader import BinaryReader, register_handler
 from .psd_primitive import PSDPrimitiveReaderMixin
 from .psd_descriptor import PSDDescriptorReaderMixin
 
@@ -38,21 +45,136 @@ IGNORED_KEYS = set([
     'shmd',     # metadata setting
 ])
 
+# Sections whose length must be rounded up to a multiple of something other
+# than 1 when skipping them.
+SECTION_ALIGNMENT = {
+    'Txt2': 2,
+}
+
+# Path records are 26 bytes: a 2-byte record type followed by 24 bytes whose
+# layout depends on the type.
+PATH_RECORD_TYPE = struct.Struct('>h')
+PATH_SUBPATH = struct.Struct('>hh20x')      # knot count, combine mode
+PATH_KNOT = struct.Struct('>6i')            # back, anchor, front (y, x each)
+PATH_CLIPBOARD = struct.Struct('>5i4x')     # top, left, bottom, right, res.
+PATH_FILL_RULE = struct.Struct('>h22x')     # initial fill rule
+
+FIXED_SCALE = float(1 << 24)
+
+if numpy is not None:
+    # Raw layout of a path record, used to decode a whole block of records
+    # with a single numpy.frombuffer.
+    PATH_RECORD_RAW_DTYPE = numpy.dtype([
+        ('type', '>i2'),
+        ('fields', '>i4', (6,)),
+    ])
+
+    # Decoded path records.  'points' holds the back, anchor and front control
+    # points of a knot as (x, y) pairs in the 0-1 range; it is unused for other
+    # record types.
+    PATH_RECORD_DTYPE = numpy.dtype([
+        ('type', 'i2'),
+        ('combine_mode', 'i2'),
+        ('points', 'f8', (3, 2)),
+    ])
+
+class LazyLayerInfo(dict):
+    """Additional layer info that is only decoded when it is first accessed.
+    'index' maps each tag to the (offset, length) of its block, as recorded by
+    'index_additional_layer_info'.  Decoded values are stored in the dict
+    itself, so iterating over it only shows the blocks decoded so far; use
+    'load' to decode everything.
+    """
+    def __init__(self, reader):
+        dict.__init__(self)
+        self.reader = reader
+        self.index = {}
+
+    def __missing__(self, key):
+        if key not in self.index:
+            raise KeyError(key)
+        self.reader.read_indexed_layer_info(self, key)
+        return dict.__getitem__(self, key)
+
+    def __contains__(self, key):
+        return key in self.index or dict.__contains__(self, key)
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def load(self):
+        for key in self.index:
+            self[key]
+        return self
+
 class PSDAdditionalLayerInfoReaderMixin(object):
+    DISPATCH_PREFIXES = ('read_ali_',)
+
+    @classmethod
+    def register_additional_layer_info_reader(cls, key, func):
+        """Use 'func(reader)' to read additional layer info blocks with the
+        tag 'key', for this class and its subclasses.  'func' is called just
+        after the tag and must consume the rest of the block, starting with
+        its length.  Register readers before creating the PSDReader that
+        uses them.
+        """
+        register_handler(cls, 'read_ali_', key, func)
+
+    def wants_layer_info(self, key):
+        """Whether blocks tagged 'key' should be decoded.  The pseudo-tag
+        'unknown' stands for the set of tags there is no reader for.
+        """
+        return self.wanted_tags is None or key in self.wanted_tags
+
+    def skip_layer_info(self, data, key):
+        """Skip the rest of a block tagged 'key', starting with its length.
+        Tags there is no reader for are noted in data['unknown'].
+        """
+        if key not in self.dispatch['read_ali_'] \
+                and key not in IGNORED_KEYS \
+                and self.wants_layer_info('unknown'):
+            if 'unknown' not in data:
+                data['unknown'] = set()
+            data['unknown'].add(key)
+        self.skip_section(SECTION_ALIGNMENT.get(key))
+
     def read_additional_layer_info(self, data):
         assert self.read_raw(4) in ('8BIM', '8B64')
         key = self.read_raw(4)
 
-        func = 'read_ali_%s' % key
-        if hasattr(self, func):
-            data[key] = getattr(self, func)()
-        elif key in IGNORED_KEYS:
-            self.skip_section()
+        func = self.dispatch['read_ali_'].get(key)
+        if func is not None and self.wants_layer_info(key):
+            data[key] = func(self)
         else:
-            if 'unknown' not in data:
-                data['unknown'] = set()
-            data['unknown'].add(key)
-            self.skip_section()
+            self.skip_layer_info(data, key)
+
+    def index_additional_layer_info(self, data):
+        """Record the position of an additional layer info block in the
+        LazyLayerInfo 'data', without decoding it.
+        """
+        offset = self.pos
+        assert self.read_raw(4) in ('8BIM', '8B64')
+        key = self.read_raw(4)
+
+        if key in self.dispatch['read_ali_'] \
+                and self.wants_layer_info(key):
+            length = self.read_uint(4)
+            data.index[key] = (offset, length)
+            self.skip(length)
+            self.skip_padding(length, SECTION_ALIGNMENT.get(key, 1))
+        else:
+            self.skip_layer_info(data, key)
+
+    def read_indexed_layer_info(self, data, key):
+        """Decode the block for 'key' in the LazyLayerInfo 'data'."""
+        self.check_open()
+        pos = self.pos
+        offset, length = data.index[key]
+        self.skip_to(offset)
+        self.read_additional_layer_info(data)
+        self.skip_to(pos)
 
 
     def read_ali_luni(self):
@@ -78,6 +200,11 @@ class PSDAdditionalLayerInfoReaderMixin(object):
         result = {}
         result['flags'] = self.read_uint(4)
 
+        if self.path_arrays and numpy is not None:
+            result['path_array'] = self.read_path_array(end_pos)
+            self.skip_to(end_pos)
+            return result
+
         path_records = []
         # Each path record is 26 bytes long.  There may be padding at the end,
         # to make it a multiple of 4 bytes in total.
@@ -96,7 +223,7 @@ class PSDAdditionalLayerInfoReaderMixin(object):
         end_pos = self.read_section_end()
         key = self.read_raw(4)
         assert self.read_int(4) == 16
-        desc = self.read_descriptor()
+        desc = self.read_descriptor_block(end_pos, 'vscg')
         self.skip_to(end_pos)
         return {key: desc}
 
@@ -107,7 +234,7 @@ class PSDAdditionalLayerInfoReaderMixin(object):
         end_pos = self.read_section_end()
 
         assert self.read_int(4) == 16
-        desc = self.read_descriptor()
+        desc = self.read_descriptor_block(end_pos, 'vstk')
 
         # The descriptor is padded to a multiple of 4 bytes.
         self.skip_to(end_pos)
@@ -117,7 +244,7 @@ class PSDAdditionalLayerInfoReaderMixin(object):
         # solid color
         end_pos = self.read_section_end()
         assert self.read_int(4) == 16
-        desc = self.read_descriptor()
+        desc = self.read_descriptor_block(end_pos, 'SoCo')
         self.skip_to(end_pos)
         return desc
 
@@ -126,7 +253,7 @@ class PSDAdditionalLayerInfoReaderMixin(object):
         end_pos = self.read_section_end()
         assert self.read_int(4) == 0
         assert self.read_int(4) == 16
-        desc = self.read_descriptor()
+        desc = self.read_descriptor_block(end_pos, 'lfx2')
         self.skip_to(end_pos)
         return desc
 
@@ -140,37 +267,64 @@ class PSDAdditionalLayerInfoReaderMixin(object):
         self.skip_section(alignment=2)
 
 
+    def read_path_array(self, end_pos):
+        """Read all of the path records up to 'end_pos' into a single numpy
+        array of PATH_RECORD_DTYPE.
+        """
+        count = (end_pos - self.pos) // 26
+        raw = numpy.frombuffer(self.read_raw(count * 26),
+                dtype=PATH_RECORD_RAW_DTYPE)
+        fields = raw['fields']
+
+        result = numpy.zeros(count, dtype=PATH_RECORD_DTYPE)
+        result['type'] = raw['type']
+
+        # Subpath records keep the knot count and combine mode in the first
+        # four bytes after the record type.
+        result['combine_mode'] = \
+                (fields[:, 0] & 0xffff).astype(numpy.uint16).view(numpy.int16)
+
+        # Knot records store each point as (y, x); swap them while scaling.
+        points = result['points']
+        points[:, :, 0] = fields[:, 1::2] / FIXED_SCALE
+        points[:, :, 1] = fields[:, 0::2] / FIXED_SCALE
+
+        return result
+
     def read_path_record(self):
         result = {}
-        record_type = self.read_int(2)
+        record_type, = self.read_struct(PATH_RECORD_TYPE)
 
         if record_type == 0 or record_type == 3:
             result['type'] = 'subpath_start'
             result['mode'] = 'closed' if record_type < 3 else 'open'
-            result['knot_count'] = self.read_int(2)
-            result['combine_mode'] = self.read_int(2)
-            self.skip(20)
+            result['knot_count'], result['combine_mode'] = \
+                    self.read_struct(PATH_SUBPATH)
         elif record_type in (1, 2, 4, 5):
+            by, bx, ay, ax, fy, fx = self.read_struct(PATH_KNOT)
             result['type'] = 'knot'
             result['mode'] = 'closed' if record_type < 3 else 'open'
             result['linked'] = record_type in (1, 4)
-            result['control_back'] = self.read_point()
-            result['control_anchor'] = self.read_point()
-            result['control_front'] = self.read_point()
+            result['control_back'] = \
+                    {'x': bx / FIXED_SCALE, 'y': by / FIXED_SCALE}
+            result['control_anchor'] = \
+                    {'x': ax / FIXED_SCALE, 'y': ay / FIXED_SCALE}
+            result['control_front'] = \
+                    {'x': fx / FIXED_SCALE, 'y': fy / FIXED_SCALE}
         elif record_type == 6:
             result['type'] = 'path_fill_rule'
             self.skip(24)
         elif record_type == 7:
+            top, left, bottom, right, resolution = \
+                    self.read_struct(PATH_CLIPBOARD)
             result['type'] = 'clipboard'
-            result['top'] = self.read_fixed()
-            result['left'] = self.read_fixed()
-            result['bottom'] = self.read_fixed()
-            result['right'] = self.read_fixed()
-            result['resolution'] = self.read_fixed()
-            self.skip(4)
+            result['top'] = top / FIXED_SCALE
+            result['left'] = left / FIXED_SCALE
+            result['bottom'] = bottom / FIXED_SCALE
+            result['right'] = right / FIXED_SCALE
+            result['resolution'] = resolution / FIXED_SCALE
         elif record_type == 8:
             result['type'] = 'initial_fill_rule'
-            result['value'] = self.read_int(2)
-            self.skip(22)
+            result['value'], = self.read_struct(PATH_FILL_RULE)
 
         return result
@@ -20,11 +20,118 @@
 # WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
 # OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
 # ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
-from .binaryreader import BinaryReader
+import collections
+
+from .binaryreader import BinaryReader, register_handler
 from .psd_primitive import PSDPrimitiveReaderMixin
 
+class FrozenDict(dict):
+    """A read-only dict, used for memoized descriptors that may be shared
+    between many layers.
+    """
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('memoized descriptors are read-only')
+
+    __setitem__ = __delitem__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+class FrozenList(list):
+    """A read-only list, the counterpart of FrozenDict.  It is still a list,
+    so it compares, prints and type-checks like the list it replaces.
+    """
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('memoized descriptors are read-only')
+
+    __setitem__ = __delitem__ = __setslice__ = __delslice__ = _read_only
+    __iadd__ = __imul__ = _read_only
+    append = extend = insert = pop = remove = reverse = sort = _read_only
+
+def freeze(value):
+    """Convert a decoded descriptor into an immutable equivalent, with dicts
+    as FrozenDicts and lists as FrozenLists.
+    """
+    if isinstance(value, dict):
+        return FrozenDict((k, freeze(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return FrozenList(freeze(v) for v in value)
+    return value
+
+class DescriptorCache(object):
+    """A bounded LRU cache of decoded descriptors, keyed on their raw
+    bytes and the set of keys decoded from them.
+    """
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        try:
+            value = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        # Re-insert to mark the entry as most recently used.
+        self.entries[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / float(lookups) if lookups else 0.0,
+        }
+
 class PSDDescriptorReaderMixin(object):
-    def read_descriptor(self):
+    DISPATCH_PREFIXES = ('read_di_', 'skip_di_')
+
+    @classmethod
+    def register_descriptor_item_reader(cls, item_type, func, skip_func=None):
+        """Use 'func(reader)' to read descriptor items of the 4-character
+        type 'item_type', for this class and its subclasses.  'skip_func'
+        should advance past such an item without decoding it.  Register
+        readers before creating the PSDReader that uses them.
+        """
+        register_handler(cls, 'read_di_', item_type, func)
+        if skip_func is not None:
+            register_handler(cls, 'skip_di_', item_type, skip_func)
+
+    def read_descriptor_block(self, end_pos, tag=None):
+        """Read a descriptor that fills the rest of a section ending at
+        'end_pos'.  If the reader has a 'descriptor_cache', identical blocks
+        are only decoded once, and the (shared, read-only) result is reused.
+
+        If the reader's 'descriptor_keys' maps 'tag' to a set of keys, only
+        those top-level items are decoded; the others are skipped.
+        """
+        keys = self.descriptor_keys.get(tag) if self.descriptor_keys else None
+        cache = self.descriptor_cache
+        if cache is None:
+            return self.read_descriptor(keys)
+
+        # The same bytes decode differently depending on which keys are
+        # wanted, so those are part of the key.
+        key = (keys, self.read_span(self.pos, end_pos))
+        result = cache.get(key)
+        if result is None:
+            result = freeze(self.read_descriptor(keys))
+            cache.put(key, result)
+        else:
+            self.skip_to(end_pos)
+        return result
+
+    def read_descriptor(self, keys=None):
+        """Read a descriptor into a dict.  If 'keys' is given, items whose
+        key is not in it are skipped without being decoded.
+        """
         name = self.read_psd_unicode(2)
         class_id = self.read_descriptor_id()
 
@@ -36,10 +143,23 @@ class PSDDescriptorReaderMixin(object):
             key = self.read_descriptor_id()
             item_type = self.read_raw(4)
 
-            result[key] = self.read_descriptor_item(item_type)
+            if keys is None or key in keys:
+                result[key] = self.read_descriptor_item(item_type)
+            else:
+                self.skip_descriptor_item(item_type)
 
         return result
 
+    def skip_descriptor(self):
+        self.skip_psd_unicode(2)
+        self.skip_descriptor_id()
+
+        item_count = self.read_int(4)
+
+        for i in xrange(item_count):
+            self.skip_descriptor_id()
+            self.skip_descriptor_item(self.read_raw(4))
+
     def read_descriptor_id(self):
         id_length = self.read_int(4)
         if id_length != 0:
@@ -47,11 +167,25 @@ class PSDDescriptorReaderMixin(object):
         else:
             return self.read_raw(4)
 
+    def skip_descriptor_id(self):
+        id_length = self.read_int(4)
+        self.skip(id_length or 4)
+
     def read_descriptor_item(self, item_type):
-        func = 'read_di_%s' % item_type.strip()
-        assert hasattr(self, func), \
+        func = self.dispatch['read_di_'].get(item_type)
+        assert func is not None, \
                 "don't know how to read descriptor item %s" % item_type
-        return getattr(self, func)()
+        return func(self)
+
+    def skip_descriptor_item(self, item_type):
+        func = self.dispatch['skip_di_'].get(item_type)
+        if func is None:
+            # Readers registered without a skip function: read the item and
+            # throw it away.
+            func = self.dispatch['read_di_'].get(item_type)
+        assert func is not None, \
+                "don't know how to skip descriptor item %s" % item_type
+        func(self)
 
 
     def read_di_Objc(self):
@@ -89,3 +223,160 @@ class PSDDescriptorReaderMixin(object):
 
     def read_di_long(self):
         return self.read_int(4)
+
+    def read_di_comp(self):
+        return self.read_int(8)
+
+    def read_di_GlbO(self):
+        return self.read_descriptor()
+
+    def read_di_type(self):
+        name = self.read_psd_unicode(2)
+        class_id = self.read_descriptor_id()
+        return {'name': name, 'class': class_id}
+
+    read_di_GlbC = read_di_type
+
+    def read_di_alis(self):
+        length = self.read_int(4)
+        return self.read_raw(length)
+
+    read_di_tdta = read_di_alis
+    read_di_Pth = read_di_alis
+
+    def read_di_UnFl(self):
+        units = self.read_raw(4)
+        count = self.read_int(4)
+        values = [self.read_double() for i in xrange(count)]
+        return {'units': units, 'values': values}
+
+    def read_di_ObAr(self):
+        # object array: an item count, then a descriptor whose items each
+        # hold that many values
+        count = self.read_int(4)
+        return {'count': count, 'items': self.read_descriptor()}
+
+    def read_di_obj(self):
+        # reference: a list of (form, value) pairs
+        count = self.read_int(4)
+        results = []
+        for i in xrange(count):
+            form = self.read_raw(4)
+            results.append((form, self.read_descriptor_item(form)))
+        return results
+
+    # The item types below only occur inside references.
+
+    def read_di_prop(self):
+        name = self.read_psd_unicode(2)
+        class_id = self.read_descriptor_id()
+        key = self.read_descriptor_id()
+        return {'name': name, 'class': class_id, 'key': key}
+
+    read_di_Clss = read_di_type
+
+    def read_di_Enmr(self):
+        name = self.read_psd_unicode(2)
+        class_id = self.read_descriptor_id()
+        type = self.read_descriptor_id()
+        enum = self.read_descriptor_id()
+        return {'name': name, 'class': class_id, 'type': type, 'enum': enum}
+
+    def read_di_rele(self):
+        name = self.read_psd_unicode(2)
+        class_id = self.read_descriptor_id()
+        offset = self.read_int(4)
+        return {'name': name, 'class': class_id, 'offset': offset}
+
+    def read_di_name(self):
+        name = self.read_psd_unicode(2)
+        class_id = self.read_descriptor_id()
+        value = self.read_psd_unicode(2)
+        return {'name': name, 'class': class_id, 'value': value}
+
+    read_di_Idnt = read_di_long
+    read_di_indx = read_di_long
+
+
+    # Skipping walks the same structures without building any objects.
+
+    def skip_di_doub(self):
+        self.skip(8)
+
+    skip_di_comp = skip_di_doub
+
+    def skip_di_UntF(self):
+        self.skip(12)
+
+    def skip_di_bool(self):
+        self.skip(1)
+
+    def skip_di_long(self):
+        self.skip(4)
+
+    skip_di_Idnt = skip_di_long
+    skip_di_indx = skip_di_long
+
+    def skip_di_Objc(self):
+        self.skip_descriptor()
+
+    skip_di_GlbO = skip_di_Objc
+
+    def skip_di_enum(self):
+        self.skip_descriptor_id()
+        self.skip_descriptor_id()
+
+    def skip_di_TEXT(self):
+        self.skip_psd_unicode(2)
+
+    def skip_di_VlLs(self):
+        count = self.read_int(4)
+        for i in xrange(count):
+            self.skip_descriptor_item(self.read_raw(4))
+
+    def skip_di_obj(self):
+        count = self.read_int(4)
+        for i in xrange(count):
+            self.skip_descriptor_item(self.read_raw(4))
+
+    def skip_di_type(self):
+        self.skip_psd_unicode(2)
+        self.skip_descriptor_id()
+
+    skip_di_GlbC = skip_di_type
+    skip_di_Clss = skip_di_type
+
+    def skip_di_alis(self):
+        self.skip(self.read_int(4))
+
+    skip_di_tdta = skip_di_alis
+    skip_di_Pth = skip_di_alis
+
+    def skip_di_ObAr(self):
+        self.skip(4)
+        self.skip_descriptor()
+
+    def skip_di_UnFl(self):
+        self.skip(4)
+        self.skip(8 * self.read_int(4))
+
+    def skip_di_prop(self):
+        self.skip_psd_unicode(2)
+        self.skip_descriptor_id()
+        self.skip_descriptor_id()
+
+    def skip_di_Enmr(self):
+        self.skip_psd_unicode(2)
+        self.skip_descriptor_id()
+        self.skip_descriptor_id()
+        self.skip_descriptor_id()
+
+    def skip_di_name(self):
+        self.skip_psd_unicode(2)
+        self.skip_descriptor_id()
+        self.skip_psd_unicode(2)
+
+    def skip_di_rele(self):
+        self.skip_psd_unicode(2)
+        self.skip_descriptor_id()
+        self.skip(4)
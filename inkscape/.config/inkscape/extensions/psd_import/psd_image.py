@@ -0,0 +1,476 @@
+# Copyright (c) 2012 Stuart Pernsteiner
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import collections
+import mmap
+import multiprocessing
+import struct
+import zlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Channel image data compression methods.
+COMPRESSION_RAW = 0
+COMPRESSION_RLE = 1
+COMPRESSION_ZIP = 2
+COMPRESSION_ZIP_PREDICTION = 3
+
+COMPRESSION_FIELD = struct.Struct('>h')
+
+# For each supported color mode, the RGBA components each channel id fills.
+# Other channels (such as layer masks, -2 and -3) are ignored.
+CHANNEL_COMPONENTS = {
+    1: {0: (0, 1, 2), -1: (3,)},            # grayscale
+    3: {0: (0,), 1: (1,), 2: (2,), -1: (3,)},   # RGB
+}
+
+def unpack_bits(data, size):
+    """Decode PackBits-compressed 'data' (any buffer) into a bytearray of
+    'size' bytes.  Each run is copied or repeated as a whole, so the loop
+    runs once per run rather than once per byte.
+    """
+    out = bytearray()
+    pos = 0
+    end = len(data)
+    while pos < end and len(out) < size:
+        header = ord(data[pos])
+        pos += 1
+        if header < 128:
+            # literal run of header + 1 bytes
+            out += data[pos:pos + header + 1]
+            pos += header + 1
+        elif header > 128:
+            # one byte repeated 257 - header times
+            out += data[pos] * (257 - header)
+            pos += 1
+        # 128 is a no-op
+    return fit_samples(out, size)
+
+def unpack_bits_rows(data, row_lengths, row_size):
+    """Decode the PackBits-compressed rows in 'data', stored back to back
+    with the byte counts in the numpy array 'row_lengths', into a bytearray
+    of 'row_size' bytes per row.  Requires numpy.
+
+    The runs of all rows are found together (each step reads the next run
+    header of every row that has data left).  Short runs are then expanded
+    in one gather: each output byte gets the index of its source byte, a
+    running sum that steps by one inside literal runs and by zero inside
+    repeated ones.  Long runs are copied as slices instead.
+    """
+    src = numpy.frombuffer(data, numpy.uint8)
+    row_count = len(row_lengths)
+    row_lengths = row_lengths.astype(numpy.intp)
+    ends = numpy.minimum(numpy.cumsum(row_lengths), len(src))
+    pos = ends - row_lengths
+    out_pos = numpy.arange(row_count, dtype=numpy.intp) * row_size
+    out_ends = out_pos + row_size
+
+    # The runs found, as arrays of rows, output positions, byte counts,
+    # source positions and whether they are literal, and how many runs each
+    # row has so far.
+    runs = []
+    run_counts = numpy.zeros(row_count, numpy.intp)
+    rows = numpy.flatnonzero(pos < ends)
+    while len(rows):
+        p = pos[rows]
+        o = out_pos[rows]
+        header = src[p].astype(numpy.intp)
+        literal = header < 128
+        # Literal runs copy header + 1 bytes, other runs repeat one byte
+        # 257 - header times, and 128 is a no-op.  Damaged runs are cut
+        # short at the end of the row's data or of its output.
+        count = numpy.where(literal, header + 1,
+                numpy.where(header > 128, 257 - header, 0))
+        available = ends[rows] - p - 1
+        count = numpy.where(literal, numpy.minimum(count, available),
+                numpy.where(available > 0, count, 0))
+        count = numpy.maximum(numpy.minimum(count, out_ends[rows] - o), 0)
+        runs.append((rows, run_counts[rows], o, count, p + 1, literal))
+        run_counts[rows] += 1
+
+        pos[rows] = p + 1 + numpy.where(literal, header + 1,
+                numpy.where(header > 128, 1, 0))
+        out_pos[rows] = o + count
+        rows = rows[(pos[rows] < ends[rows])
+                & (out_pos[rows] < out_ends[rows])]
+
+    # Rows that end early are padded by repeating a zero byte appended to
+    # the source, so the runs cover the whole output.
+    src = numpy.append(src, numpy.uint8(0))
+    all_rows = numpy.arange(row_count, dtype=numpy.intp)
+    runs.append((all_rows, run_counts.copy(), out_pos, out_ends - out_pos,
+        numpy.full(row_count, len(src) - 1, numpy.intp),
+        numpy.zeros(row_count, bool)))
+    run_counts += 1
+
+    # Each row's runs were found one per step, so the runs are put in
+    # output order by their row's offset plus their step, without sorting.
+    row, step, o, count, first, literal = [numpy.concatenate(column)
+            for column in zip(*runs)]
+    order = numpy.empty(len(row), numpy.intp)
+    order[(numpy.cumsum(run_counts) - run_counts)[row] + step] = \
+            numpy.arange(len(row), dtype=numpy.intp)
+    order = order[count[order] > 0]
+    count = count[order]
+    first = first[order]
+    literal = literal[order].astype(numpy.intp)
+
+    if len(count) * 32 < row_count * row_size:
+        # Long runs are cheaper to copy as slices than byte by byte.
+        data = src.tostring()
+        out = bytearray()
+        for count, first, literal in zip(
+                count.tolist(), first.tolist(), literal.tolist()):
+            if literal:
+                out += data[first:first + count]
+            else:
+                out += data[first] * count
+        return out
+
+    steps = numpy.repeat(literal, count)
+    starts = numpy.cumsum(count) - count
+    # At the start of each run, jump from the last source index of the
+    # previous run to the first of this one.
+    last = first + literal * (count - 1)
+    steps[starts] = first - numpy.concatenate(([0], last[:-1]))
+    return bytearray(src[numpy.cumsum(steps)].tostring())
+
+def fit_samples(samples, size):
+    """Truncate or zero-pad 'samples' to exactly 'size' bytes, in case the
+    channel data is damaged.
+    """
+    if len(samples) > size:
+        del samples[size:]
+    elif len(samples) < size:
+        samples += '\0' * (size - len(samples))
+    return samples
+
+def undo_prediction(data, width, height, depth):
+    """Undo the per-row delta encoding of ZIP-with-prediction channel data.
+    Requires numpy.
+    """
+    dtype = '>u2' if depth == 16 else 'u1'
+    deltas = numpy.frombuffer(data, dtype=dtype)[:width * height]
+    samples = numpy.cumsum(deltas.reshape(height, width), axis=1,
+            dtype=deltas.dtype.newbyteorder('='))
+    return bytearray(samples.astype(dtype).tostring())
+
+def samples_to_8bit(samples, depth, size):
+    """Convert decoded channel samples of the given bit depth into a
+    bytearray of 'size' 8-bit samples, keeping the high byte of 16-bit ones.
+    """
+    if depth == 16:
+        samples = bytearray(str(samples)[0::2])
+    elif not isinstance(samples, bytearray):
+        samples = bytearray(samples)
+    return fit_samples(samples, size)
+
+
+def decode_channel_data(data, width, height, depth):
+    """Decode the image data of a channel, 'data' (any buffer, starting with
+    the compression method), into a bytearray of width * height 8-bit
+    samples.  Returns None for unsupported compression methods.
+    """
+    compression, = COMPRESSION_FIELD.unpack_from(data)
+    start = COMPRESSION_FIELD.size
+    if compression == COMPRESSION_RLE:
+        # skip the byte counts of the compressed rows
+        start += 2 * height
+    data = buffer(data, start)
+
+    size = width * height * depth // 8
+    if compression == COMPRESSION_RAW:
+        samples = data
+    elif compression == COMPRESSION_RLE:
+        samples = unpack_bits(data, size)
+    elif compression == COMPRESSION_ZIP:
+        samples = zlib.decompress(data)
+    elif compression == COMPRESSION_ZIP_PREDICTION and numpy is not None:
+        samples = undo_prediction(zlib.decompress(data), width, height, depth)
+    else:
+        return None
+
+    return samples_to_8bit(samples, depth, width * height)
+
+def assemble_rgba(count, channels):
+    """Interleave the 8-bit samples of 'channels', a sequence of (components,
+    samples) pairs, into a bytearray of 'count' RGBA pixels.  Returns None
+    if any of the samples are None.
+    """
+    rgba = bytearray(count * 4)
+    # opaque unless there is an alpha channel
+    rgba[3::4] = '\xff' * count
+
+    for components, samples in channels:
+        if samples is None:
+            return None
+        for component in components:
+            rgba[component::4] = samples
+
+    return rgba
+
+
+class DecodedImage(object):
+    """Pixels that have already been decoded, with the same interface as
+    LayerImage.
+    """
+    def __init__(self, left, top, width, height, rgba):
+        self.left = left
+        self.top = top
+        self.width = width
+        self.height = height
+        self.rgba = rgba
+
+    def read(self):
+        return self.rgba
+
+    def __repr__(self):
+        return '<DecodedImage %dx%d at %d,%d>' % (self.width, self.height,
+                self.left, self.top)
+
+class LayerImage(object):
+    """The pixels of a layer, decoded when 'read' is called.  The reader's
+    stream must stay open until then.
+    """
+    def __init__(self, reader, layer):
+        self.reader = reader
+        self.layer = layer
+        bounds = layer['bounds']
+        self.left = bounds['left']
+        self.top = bounds['top']
+        self.width = bounds['right'] - bounds['left']
+        self.height = bounds['bottom'] - bounds['top']
+        # The ParallelImageDecoder this image was scheduled with, and its
+        # channels being decoded, as (components, AsyncResult) pairs.
+        self.decoder = None
+        self.pending = None
+
+    def read(self):
+        """Return the pixels as a bytearray of interleaved 8-bit RGBA
+        samples, row by row, or None if the image format isn't supported.
+        """
+        if self.decoder is None:
+            return self.reader.read_layer_pixels(self.layer)
+
+        pending = self.decoder.take(self)
+        return assemble_rgba(self.width * self.height,
+                ((components, result.get()) for components, result in pending))
+
+    def __repr__(self):
+        return '<LayerImage %dx%d at %d,%d>' % (self.width, self.height,
+                self.left, self.top)
+
+class PSDImageReaderMixin(object):
+    def read_channel(self, channel, width, height):
+        """Decode the image data of a layer channel (with the 'offset' and
+        'length' of its data) into a bytearray of width * height 8-bit
+        samples.  Returns None for unsupported compression methods.
+        """
+        start = channel['offset']
+        data = self.read_view(start, start + channel['length'])
+        return decode_channel_data(data, width, height, self.channel_depth)
+
+    def images_supported(self):
+        """Return True if layer images in this file's color mode and depth
+        can be decoded.
+        """
+        return self.color_mode in CHANNEL_COMPONENTS \
+                and self.channel_depth in (8, 16)
+
+    def iter_image_channels(self, layer):
+        """Yield the RGBA components and the channel dict for each channel
+        of 'layer' that contributes to its image.
+        """
+        components = CHANNEL_COMPONENTS[self.color_mode]
+        for channel in layer['channels']:
+            if channel['id'] in components:
+                yield components[channel['id']], channel
+
+    def read_layer_pixels(self, layer):
+        """Decode the channels of 'layer' into a bytearray of interleaved
+        8-bit RGBA samples.  Channels are decoded one at a time, straight
+        into the result, so at most one channel's samples are held besides
+        it.  Returns None if the color mode, depth or compression isn't
+        supported.
+        """
+        self.check_open()
+        if not self.images_supported():
+            return None
+
+        bounds = layer['bounds']
+        width = bounds['right'] - bounds['left']
+        height = bounds['bottom'] - bounds['top']
+
+        return assemble_rgba(width * height,
+                ((components, self.read_channel(channel, width, height))
+                    for components, channel in self.iter_image_channels(layer)))
+
+    def read_image_data(self, has_alpha=False):
+        """Read the merged image data section at the end of the file into a
+        DecodedImage, or return None if its format isn't supported.  The
+        header must have been read already.  Unless 'has_alpha' is set, the
+        image is opaque and any extra channels (saved selections, spot
+        colors) are ignored.
+        """
+        if not self.images_supported():
+            return None
+
+        width = self.psd['dimensions']['width']
+        height = self.psd['dimensions']['height']
+        count = width * height
+        channel_size = count * self.channel_depth // 8
+        size = self.channel_count * channel_size
+
+        compression = self.read_int(2)
+        if compression == COMPRESSION_RAW:
+            samples = self.read_view(self.pos, self.pos + size)
+        elif compression == COMPRESSION_RLE:
+            # The byte counts of all rows of all channels come first, then
+            # the rows themselves, back to back.
+            row_count = self.channel_count * height
+            if numpy is not None:
+                start = self.pos
+                row_lengths = numpy.frombuffer(
+                        self.read_view(start, start + 2 * row_count), '>u2')
+                self.skip(2 * row_count)
+                start = self.pos
+                samples = unpack_bits_rows(
+                        self.read_view(start, start + int(row_lengths.sum())),
+                        row_lengths, width * self.channel_depth // 8)
+            else:
+                # Without numpy, decode the rows as one stream.
+                row_lengths = self.read_struct(
+                        struct.Struct('>%dH' % row_count))
+                start = self.pos
+                samples = unpack_bits(
+                        self.read_view(start, start + sum(row_lengths)), size)
+        else:
+            return None
+
+        components = CHANNEL_COMPONENTS[self.color_mode]
+        channel_ids = range(len(components) - 1)
+        if has_alpha:
+            channel_ids.append(-1)
+        rgba = assemble_rgba(count, ((components[channel_id],
+                samples_to_8bit(samples[i * channel_size:
+                    (i + 1) * channel_size], self.channel_depth, count))
+                for i, channel_id in enumerate(channel_ids)
+                if i < self.channel_count))
+        return DecodedImage(0, 0, width, height, rgba)
+
+
+# The mapped input file of a ParallelImageDecoder worker process.
+_worker_buf = None
+
+def init_channel_worker(filename):
+    global _worker_buf
+    with open(filename, 'rb') as f:
+        _worker_buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def decode_channel_task(task):
+    offset, length, width, height, depth = task
+    samples = decode_channel_data(buffer(_worker_buf, offset, length),
+            width, height, depth)
+    # Plain strings are much cheaper to send back than bytearrays.
+    return str(samples) if samples is not None else None
+
+class ParallelImageDecoder(object):
+    """Decodes the channels of layers in a pool of processes, a few layers
+    ahead of the one being converted.  Each worker maps the PSD file itself,
+    so only channel offsets and decoded samples are passed between
+    processes.
+    """
+    def __init__(self, filename, processes=None, ahead=None):
+        self.pool = multiprocessing.Pool(processes, init_channel_worker,
+                (filename,))
+        if ahead is None:
+            ahead = 2 * (processes or multiprocessing.cpu_count())
+        self.ahead = ahead
+        self.reader = None
+        # Scheduled images that haven't been started, and the started ones
+        # that haven't been read yet, both in layer order.
+        self.waiting = collections.deque()
+        self.started = collections.deque()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.pool.close()
+        else:
+            self.pool.terminate()
+        self.pool.join()
+
+    def schedule(self, reader, layers):
+        """Decode the images of 'layers', which were read by 'reader', in
+        the background.  At most 'ahead' images are decoded before they are
+        read, so the images should be read in layer order.
+        """
+        if not reader.images_supported():
+            return
+
+        self.reader = reader
+        for layer in layers:
+            image = layer.get('image')
+            if image is not None:
+                image.decoder = self
+                self.waiting.append(image)
+        self.fill()
+
+    def start(self, image):
+        reader = self.reader
+        pending = []
+        for components, channel in reader.iter_image_channels(image.layer):
+            task = (reader.offset + channel['offset'], channel['length'],
+                    image.width, image.height, reader.channel_depth)
+            pending.append((components,
+                self.pool.apply_async(decode_channel_task, (task,))))
+        image.pending = pending
+        self.started.append(image)
+
+    def fill(self):
+        while len(self.started) < self.ahead and self.waiting:
+            self.start(self.waiting.popleft())
+
+    def take(self, image):
+        """Return the (components, AsyncResult) pairs of a scheduled image,
+        and start decoding the next ones.
+        """
+        while image.pending is None and self.waiting:
+            self.start(self.waiting.popleft())
+
+        # Images started before this one weren't read; drop their results.
+        while self.started:
+            skipped = self.started.popleft()
+            if skipped is image:
+                break
+            skipped.decoder = skipped.pending = None
+
+        pending, image.pending = image.pending, None
+        image.decoder = None
+        self.fill()
+        return pending
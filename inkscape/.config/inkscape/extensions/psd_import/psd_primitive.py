@@ -26,13 +26,23 @@ class PSDPrimitiveReaderMixin(object):
     def read_psd_unicode(self, alignment=4):
         """Read a PSD-format Unicode string."""
         length = self.read_int(4)
-        string = u''.join(unichr(self.read_int(2)) for i in xrange(length))
+        # The string is UTF-16BE; decoding it in one go also joins surrogate
+        # pairs (characters outside the BMP, such as emoji).
+        string = self.read_raw(length * 2).decode('utf-16-be', 'replace')
 
         if alignment is not None:
             self.skip_padding(length * 2, alignment)
 
         return string
 
+    def skip_psd_unicode(self, alignment=4):
+        """Skip a PSD-format Unicode string without decoding it."""
+        length = self.read_int(4)
+        self.skip(length * 2)
+
+        if alignment is not None:
+            self.skip_padding(length * 2, alignment)
+
     def read_psd_string(self, alignment=4):
         """Read a PSD-format 8-bit string (called a "Pascal string" in the
         documentation).
@@ -20,14 +20,25 @@
 # WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
 # OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
 # ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import contextlib
+import hashlib
+import struct
 import sys
 
 from .binaryreader import BinaryReader
-from .psd_additional import PSDAdditionalLayerInfoReaderMixin
-from .psd_descriptor import PSDDescriptorReaderMixin
+from .psd_additional import PSDAdditionalLayerInfoReaderMixin, LazyLayerInfo
+from .psd_descriptor import PSDDescriptorReaderMixin, DescriptorCache
+from .psd_image import PSDImageReaderMixin, LayerImage
 from .psd_primitive import PSDPrimitiveReaderMixin
 
 
+# Fixed-layout parts of a layer record.
+LAYER_BOUNDS = struct.Struct('>4i')         # top, left, bottom, right
+LAYER_CHANNEL = struct.Struct('>hi')        # channel id, data length
+LAYER_BLENDING = struct.Struct('>4s4sBBBx') # signature, blend mode, opacity,
+                                            # clipping, flags, filler
+
+
 def dump_hex(buf):
     for i in xrange(0,len(buf),16):
         chunk = buf[i:i+16]
@@ -40,26 +51,112 @@ def dump_hex(buf):
 class PSDReader(BinaryReader,
         PSDPrimitiveReaderMixin,
         PSDDescriptorReaderMixin,
-        PSDAdditionalLayerInfoReaderMixin):
-    def __init__(self, stream):
-        super(PSDReader, self).__init__(stream)
+        PSDAdditionalLayerInfoReaderMixin,
+        PSDImageReaderMixin):
+    def __init__(self, stream, use_mmap=True, path_arrays=False, lazy=False,
+            fingerprints=False, descriptor_cache_size=256,
+            descriptor_keys=None, wanted_tags=None, images=False):
+        """If 'path_arrays' is set and numpy is available, vector mask path
+        records are decoded into a single numpy array ('path_array') instead
+        of a list of dicts ('path_records').
+
+        If 'lazy' is set, layer records are only indexed: each layer's
+        'extra' is a LazyLayerInfo that decodes its blocks on first access.
+        The underlying stream must stay open while the layers are in use.
+
+        If 'fingerprints' is set, each layer gets a 'fingerprint': a hash of
+        its raw record, including all of its additional layer info, its
+        channel data (if 'images' is set), and the file's color mode and
+        depth, which decide how that data is read.
+
+        Descriptors (layer effects, fills, strokes) are memoized on their raw
+        bytes in a cache of 'descriptor_cache_size' entries, so presets shared
+        by many layers are decoded once.  The decoded descriptors are
+        read-only.  Pass 0 to disable the cache.
+
+        'descriptor_keys' may map additional layer info tags (like 'lfx2') to
+        the set of top-level descriptor keys to decode; other keys in those
+        descriptors are skipped.
+
+        If 'wanted_tags' is given, only the additional layer info blocks with
+        those tags are decoded (or indexed, if 'lazy' is set); the rest are
+        skipped by their length.  Include 'unknown' to still collect the
+        tags there is no reader for.
+
+        If 'images' is set, each layer's channels get the 'offset' of their
+        image data, and layers with pixels get an 'image', a LayerImage that
+        decodes them on demand.  Fingerprints then cover the pixels too.
+        """
+        super(PSDReader, self).__init__(stream, use_mmap)
+        self.path_arrays = path_arrays
+        self.lazy = lazy
+        self.fingerprints = fingerprints
+        self.descriptor_cache = DescriptorCache(descriptor_cache_size) \
+                if descriptor_cache_size else None
+        self.descriptor_keys = descriptor_keys
+        self.wanted_tags = wanted_tags
+        self.images = images
 
     def dump(self, count=128):
         dump_hex(self.read_raw(count))
         self.skip(-count)
 
-    def read_psd(self):
+    @contextlib.contextmanager
+    def dump_on_assertion(self):
+        """Dump the data at the current position if parsing fails."""
         try:
+            yield
+        except AssertionError:
+            sys.stderr.write('Assertion failed on data:\n')
+            self.dump()
+            raise
+
+    def read_psd(self):
+        self.read_psd_header()
+        self.psd['layers'] = list(self.iter_layers())
+        return self.psd
+
+    def read_psd_header(self):
+        """Read everything that comes before the layer records.  Afterward,
+        self.psd holds the image bounds and dimensions.
+        """
+        with self.dump_on_assertion():
             self.psd = {}
             self.read_header()
             self.read_color_mode_data()
             self.read_image_resources()
-            self.read_layer_and_mask_info()
             return self.psd
-        except AssertionError:
-            sys.stderr.write('Assertion failed on data:\n')
-            self.dump()
-            raise
+
+    def read_composite(self):
+        """Read only the header and the merged image, seeking past everything
+        in between by section length.  Returns a DecodedImage, or None if
+        the file's color mode or depth isn't supported.
+        """
+        with self.dump_on_assertion():
+            self.psd = {}
+            self.read_header()
+            self.read_color_mode_data()
+            self.read_image_resources()
+
+            # Layer and mask info.  Only the sign of the layer count is
+            # needed: it is negative if the first extra channel of the merged
+            # image holds its transparency.
+            end_pos = self.read_section_end()
+            has_alpha = False
+            if end_pos - self.pos >= 6 and self.read_uint(4) >= 2:
+                has_alpha = self.read_int(2) < 0
+            self.skip_to(end_pos)
+            return self.read_image_data(has_alpha)
+
+    def iter_layers(self):
+        """Read the layer and mask info section, yielding each layer as soon
+        as its record has been parsed.  Must be called after
+        'read_psd_header'.  self.psd['extra'] is filled in once the last layer
+        has been yielded.
+        """
+        with self.dump_on_assertion():
+            for layer in self.iter_layer_and_mask_info():
+                yield layer
 
     def read_header(self):
         assert self.read_raw(4) == '8BPS'   # signature
@@ -72,6 +169,10 @@ class PSDReader(BinaryReader,
         channel_depth = self.read_int(2)
         color_mode = self.read_int(2)
 
+        self.channel_count = channel_count
+        self.channel_depth = channel_depth
+        self.color_mode = color_mode
+
         self.psd['bounds'] = {
             'top': 0,
             'left': 0,
@@ -89,10 +190,11 @@ class PSDReader(BinaryReader,
     def read_image_resources(self):
         self.skip_section()
 
-    def read_layer_and_mask_info(self):
+    def iter_layer_and_mask_info(self):
         end_pos = self.read_section_end()
 
-        self.read_layer_info()
+        for layer in self.iter_layer_info():
+            yield layer
         self.read_global_layer_mask_info()
 
         # skip remaining additional layer info sections
@@ -103,45 +205,69 @@ class PSDReader(BinaryReader,
 
         self.skip_to(end_pos)
 
-    def read_layer_info(self):
+    def iter_layer_info(self):
         end_pos = self.read_section_end()
 
         # layer_count might be negative, in which case there are
         # abs(layer_count) actual layers.
         layer_count = abs(self.read_int(2))
 
-        self.psd['layers'] = \
-                [self.read_layer_record() for _ in xrange(layer_count)]
+        if self.images:
+            # The channel image data of all layers follows the last record.
+            self.channel_data_pos = self.find_channel_data(layer_count)
+
+        for _ in xrange(layer_count):
+            yield self.read_layer_record()
 
         # Skip all channel image data
         self.skip_to(end_pos)
 
+    def find_channel_data(self, layer_count):
+        """Find where the channel image data starts, by skipping over the
+        'layer_count' layer records that come before it.
+        """
+        pos = self.pos
+        for _ in xrange(layer_count):
+            self.skip(LAYER_BOUNDS.size)
+            channel_count = self.read_uint(2)
+            self.skip(channel_count * LAYER_CHANNEL.size + LAYER_BLENDING.size)
+            self.skip_section()
+        data_pos = self.pos
+        self.skip_to(pos)
+        return data_pos
+
     def read_layer_record(self):
         layer = {}
+        layer['offset'] = self.pos
 
+        top, left, bottom, right = self.read_struct(LAYER_BOUNDS)
         layer['bounds'] = {
-            'top':    self.read_int(4),
-            'left':   self.read_int(4),
-            'bottom': self.read_int(4),
-            'right':  self.read_int(4),
+            'top':    top,
+            'left':   left,
+            'bottom': bottom,
+            'right':  right,
         }
 
         channel_count = self.read_uint(2)
 
         layer['channels'] = []
         for i in xrange(channel_count):
+            channel_id, length = self.read_struct(LAYER_CHANNEL)
             channel = {
-                'id': self.read_int(2),
-                'length': self.read_int(4),
+                'id': channel_id,
+                'length': length,
             }
+            if self.images:
+                channel['offset'] = self.channel_data_pos
+                self.channel_data_pos += length
             layer['channels'].append(channel)
 
-        assert self.read_raw(4) == '8BIM'
-        blend_mode = self.read_raw(4)
-        layer['opacity'] = self.read_uint(1)
-        layer['clipping'] = self.read_uint(1)
-        layer['flags'] = self.read_uint(1)
-        self.skip(1)
+        signature, blend_mode, opacity, clipping, flags = \
+                self.read_struct(LAYER_BLENDING)
+        assert signature == '8BIM'
+        layer['opacity'] = opacity
+        layer['clipping'] = clipping
+        layer['flags'] = flags
 
         # Extra layer data section
 
@@ -155,9 +281,27 @@ class PSDReader(BinaryReader,
 
         layer['name'] = self.read_psd_string()
 
-        layer['extra'] = {}
-        while self.pos < end_pos:
-            self.read_additional_layer_info(layer['extra'])
+        if self.lazy:
+            layer['extra'] = LazyLayerInfo(self)
+            while self.pos < end_pos:
+                self.index_additional_layer_info(layer['extra'])
+        else:
+            layer['extra'] = {}
+            while self.pos < end_pos:
+                self.read_additional_layer_info(layer['extra'])
+
+        if self.images and top < bottom and left < right:
+            layer['image'] = LayerImage(self, layer)
+
+        if self.fingerprints:
+            digest = hashlib.sha1('%d,%d:' % (self.color_mode,
+                self.channel_depth))
+            digest.update(self.read_span(layer['offset'], self.pos))
+            if self.images:
+                for channel in layer['channels']:
+                    digest.update(self.read_view(channel['offset'],
+                        channel['offset'] + channel['length']))
+            layer['fingerprint'] = digest.hexdigest()
 
         return layer
 
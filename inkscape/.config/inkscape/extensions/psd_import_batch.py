@@ -0,0 +1,191 @@
+# Copyright (c) 2012 Stuart Pernsteiner
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#!/usr/bin/env python
+"""Convert a batch of PSD files to SVG, spreading the work over several
+processes.  Prints one line per input: status, seconds, input file, and the
+error message for failed conversions.
+"""
+import glob
+import multiprocessing
+import optparse
+import os
+import sys
+import time
+
+import psd_import_main
+
+
+# Per-process conversion cache, set up by init_worker.
+cache = None
+
+def cache_counts():
+    """Return the hits, layer hits and layer misses of this process's cache
+    so far.
+    """
+    if cache is None:
+        return 0, 0, 0
+    return cache.hits, cache.layers.hits, cache.layers.misses
+
+def convert_one(job):
+    filename, out_filename, output_format = job
+    output_format = output_format.replace(
+            svg_dir=os.path.dirname(os.path.abspath(out_filename)))
+
+    start = time.time()
+    before = cache_counts()
+    try:
+        svg = psd_import_main.convert_psd_file(filename, cache,
+                output_format=output_format)
+        with open(out_filename, 'wb') as f:
+            f.write(svg)
+    except Exception as e:
+        # Catches AssertionErrors from unsupported PSD features too, so one
+        # bad file doesn't abort the batch.
+        status = 'failed'
+        message = '%s: %s' % (type(e).__name__, e)
+    else:
+        status = 'ok'
+        message = ''
+
+    hits, layer_hits, layer_misses = [count - previous
+            for count, previous in zip(cache_counts(), before)]
+    return {
+        'input': filename,
+        'output': out_filename,
+        'status': status,
+        'message': message,
+        'seconds': time.time() - start,
+        'cached': hits > 0,
+        'layer_hits': layer_hits,
+        'layer_misses': layer_misses,
+        'size': os.path.getsize(filename) if os.path.exists(filename) else 0,
+    }
+
+def init_worker(options):
+    global cache
+    cache = psd_import_main.open_cache(options)
+
+def expand_inputs(args):
+    """Expand glob patterns in 'args' (for shells that don't), keeping the
+    order of the arguments.
+    """
+    filenames = []
+    for arg in args:
+        matches = sorted(glob.glob(arg)) if glob.has_magic(arg) else [arg]
+        filenames.extend(matches)
+    return filenames
+
+def output_filename(filename, output_dir):
+    base = os.path.splitext(filename)[0] + '.svg'
+    if output_dir is None:
+        return base
+    return os.path.join(output_dir, os.path.basename(base))
+
+def output_filenames(filenames, output_dir):
+    """Return the output filename of each of 'filenames'.  Inputs that would
+    overwrite an earlier input's output (same basename in different
+    directories, with -o) get a numbered suffix instead, with a warning.
+    """
+    taken = set()
+    out_filenames = []
+    for filename in filenames:
+        out_filename = output_filename(filename, output_dir)
+        root, ext = os.path.splitext(out_filename)
+        number = 1
+        while os.path.normcase(os.path.abspath(out_filename)) in taken:
+            number += 1
+            out_filename = '%s-%d%s' % (root, number, ext)
+        if number > 1:
+            sys.stderr.write('%s: output name taken, writing %s\n' %
+                    (filename, out_filename))
+        taken.add(os.path.normcase(os.path.abspath(out_filename)))
+        out_filenames.append(out_filename)
+    return out_filenames
+
+def parse_args(argv):
+    parser = optparse.OptionParser(
+            usage='%prog [options] FILE.psd|PATTERN ...')
+    parser.add_option('-o', '--output-dir', default=None,
+            help='directory to write the SVGs to (default: next to each '
+                 'input); inputs with the same name get a numbered suffix')
+    parser.add_option('-j', '--jobs', type='int',
+            default=multiprocessing.cpu_count(),
+            help='number of worker processes (default: one per CPU)')
+    psd_import_main.add_output_options(parser)
+    psd_import_main.add_cache_options(parser)
+    options, args = parser.parse_args(argv)
+    if not args:
+        parser.error('no input files')
+    return options, args
+
+def main(argv):
+    options, args = parse_args(argv)
+
+    filenames = expand_inputs(args)
+    if options.output_dir is not None and not os.path.isdir(options.output_dir):
+        os.makedirs(options.output_dir)
+    output_format = psd_import_main.get_output_format(options)
+    jobs = [(filename, out_filename, output_format)
+            for filename, out_filename in zip(filenames,
+                output_filenames(filenames, options.output_dir))]
+
+    if options.jobs > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(min(options.jobs, len(jobs)),
+                init_worker, (options,))
+        results = pool.imap_unordered(convert_one, jobs)
+    else:
+        pool = None
+        init_worker(options)
+        results = (convert_one(job) for job in jobs)
+
+    start = time.time()
+    failures = 0
+    cache_stats = {'hits': 0, 'misses': 0, 'bytes_saved': 0,
+            'layer_hits': 0, 'layer_misses': 0}
+    for result in results:
+        cache_stats['layer_hits'] += result['layer_hits']
+        cache_stats['layer_misses'] += result['layer_misses']
+        if result['status'] != 'ok':
+            failures += 1
+        elif result['cached']:
+            cache_stats['hits'] += 1
+            cache_stats['bytes_saved'] += result['size']
+        else:
+            cache_stats['misses'] += 1
+        status = 'cached' if result['cached'] else result['status']
+        sys.stdout.write('%s\t%.3f\t%s\t%s\n' % (status,
+            result['seconds'], result['input'], result['message']))
+        sys.stdout.flush()
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    sys.stderr.write('%d converted, %d failed in %.3f seconds\n' %
+            (len(jobs) - failures, failures, time.time() - start))
+    if options.cache_dir is not None:
+        sys.stderr.write(psd_import_main.format_cache_stats(cache_stats))
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,147 @@
+# Copyright (c) 2012 Stuart Pernsteiner
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#!/usr/bin/env python
+"""Time parsing PSD files with the memory-mapped BinaryReader against the
+plain stream reader.  Without input files, a synthetic file with many shape
+layers is generated.  Prints one line per file: size, the best time of each
+backend over the repeats, and the speedup.
+"""
+import optparse
+import os
+import struct
+import sys
+import tempfile
+import time
+
+from psd_import.psdreader import PSDReader
+from psd_import_main import DESCRIPTOR_KEYS, LAYER_INFO_TAGS
+
+
+def pack(fmt, *args):
+    return struct.pack('>' + fmt, *args)
+
+def unicode_string(s):
+    return pack('I', len(s)) + s.encode('utf-16-be')
+
+def layer_info(key, data):
+    data += '\0' * (-len(data) % 4)
+    return '8BIM' + key + pack('I', len(data)) + data
+
+def solid_color(r, g, b):
+    """A 'SoCo' block: a descriptor holding one RGB color."""
+    color = ''.join(pack('I', 0) + key + 'doub' + pack('d', value)
+            for key, value in (('Rd  ', r), ('Grn ', g), ('Bl  ', b)))
+    color = unicode_string(u'') + pack('I', 0) + 'RGBC' + pack('I', 3) + color
+    descriptor = unicode_string(u'') + pack('I', 0) + 'null' + pack('I', 1) \
+            + pack('I', 0) + 'Clr ' + 'Objc' + color
+    return layer_info('SoCo', pack('i', 16) + descriptor)
+
+def rect_mask(left, top, right, bottom):
+    """A 'vmsk' block with one closed rectangular subpath, in fractions of
+    the canvas.
+    """
+    def fixed(v):
+        return pack('i', int(round(v * (1 << 24))))
+    data = pack('II', 3, 0) + pack('h', 6) + '\0' * 24
+    data += pack('hhh', 0, 4, 1) + '\0' * 20
+    for x, y in ((left, top), (right, top), (right, bottom), (left, bottom)):
+        data += pack('h', 2) + (fixed(y) + fixed(x)) * 3
+    return layer_info('vmsk', data)
+
+def layer_record(name, blocks):
+    record = pack('iiii', 0, 0, 0, 0) + pack('H', 0)
+    record += '8BIM' + 'norm' + pack('BBBB', 255, 0, 0, 0)
+    pascal_name = name.encode('ascii')[:255]
+    pascal_name = chr(len(pascal_name)) + pascal_name
+    pascal_name += '\0' * (-len(pascal_name) % 4)
+    extra = pack('II', 0, 0) + pascal_name \
+            + layer_info('luni', unicode_string(name)) + ''.join(blocks)
+    return record + pack('I', len(extra)) + extra
+
+def synthetic_psd(layer_count, width=2000, height=2000):
+    """Return the data of a PSD file with 'layer_count' filled rectangles
+    and no merged image.
+    """
+    records = []
+    for i in xrange(layer_count):
+        x = (i % 97) / 100.0
+        y = (i // 97 % 97) / 100.0
+        records.append(layer_record(u'rect %d' % i, [
+            solid_color(i % 256, i // 256 % 256, 128),
+            rect_mask(x, y, x + 0.02, y + 0.02)]))
+
+    layers = pack('h', layer_count) + ''.join(records)
+    layers += '\0' * (len(layers) % 2)
+    layer_and_mask = pack('I', len(layers)) + layers + pack('I', 0)
+    return '8BPS' + pack('hhi', 1, 0, 0) + pack('hiihh', 3, height, width, 8, 3) \
+            + pack('I', 0) + pack('I', 0) \
+            + pack('I', len(layer_and_mask)) + layer_and_mask
+
+def time_parse(filename, use_mmap, repeat):
+    """Return the best time, over 'repeat' runs, to parse 'filename' the
+    way the converter does.
+    """
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        with open(filename, 'rb') as f, PSDReader(f, use_mmap=use_mmap,
+                path_arrays=True, descriptor_keys=DESCRIPTOR_KEYS,
+                wanted_tags=LAYER_INFO_TAGS) as psdr:
+            psdr.read_psd()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def parse_args(argv):
+    parser = optparse.OptionParser(usage='%prog [options] [FILE.psd ...]')
+    parser.add_option('--layers', type='int', default=20000,
+            help='number of layers in the synthetic file (default: 20000)')
+    parser.add_option('--repeat', type='int', default=3,
+            help='number of runs per backend (default: 3)')
+    return parser.parse_args(argv)
+
+def main(argv):
+    options, filenames = parse_args(argv)
+
+    temp_path = None
+    if not filenames:
+        fd, temp_path = tempfile.mkstemp(suffix='.psd')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(synthetic_psd(options.layers))
+        filenames = [temp_path]
+
+    try:
+        for filename in filenames:
+            stream_time = time_parse(filename, False, options.repeat)
+            mmap_time = time_parse(filename, True, options.repeat)
+            sys.stdout.write('%d bytes\tstream %.3f s\tmmap %.3f s\t'
+                    '%.2fx\t%s\n' % (os.path.getsize(filename), stream_time,
+                        mmap_time, stream_time / mmap_time, filename))
+    finally:
+        if temp_path is not None:
+            os.remove(temp_path)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
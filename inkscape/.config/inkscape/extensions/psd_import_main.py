@@ -23,107 +23,342 @@
 #!/usr/bin/env python
 from lxml import etree
 import math
+import multiprocessing
+import optparse
+import os
 from pprint import pprint
+import re
 import sys
 
+from psd_import.cache import ConversionCache, hash_file, make_key
+from psd_import.psd_image import ParallelImageDecoder
 from psd_import.psdreader import PSDReader
 
-from psd_import.p2s_gradient import construct_gradient
-from psd_import.p2s_path import construct_path
+from psd_import.p2s_gradient import construct_gradient, GradientPool
+from psd_import.p2s_image import construct_image
+from psd_import.p2s_path import construct_path, psd_path_records_bounds
+from psd_import.p2s_region import GridIndex, is_empty, parse_region, union
+from psd_import.p2s_shapes import construct_box
 from psd_import.p2s_util import *
 
 
+# The descriptor keys the conversion looks at, per additional layer info tag.
+# Everything else in those descriptors is skipped while parsing.
+DESCRIPTOR_KEYS = {
+    'lfx2': frozenset(['masterFXSwitch', 'GrFl']),
+    'SoCo': frozenset(['Clr ']),
+    'vstk': frozenset(['fillEnabled']),
+}
 
-def process_psd(psd):
+# The additional layer info tags the conversion uses; other blocks are skipped.
+LAYER_INFO_TAGS = frozenset(['luni', 'lsct', 'lsdk', 'vmsk', 'vsms', 'vscg',
+    'vstk', 'SoCo', 'lfx2'])
+
+def create_svg_root(psd, region=None, output_format=DEFAULT_OUTPUT_FORMAT):
     svg = etree.Element('{%s}svg' % NS_SVG)
-    svg.set('width', '%s' % psd['dimensions']['width'])
-    svg.set('height', '%s' % psd['dimensions']['height'])
+    if region is None:
+        svg.set('width', '%s' % psd['dimensions']['width'])
+        svg.set('height', '%s' % psd['dimensions']['height'])
+    else:
+        # Show only the region, keeping the document's coordinates.
+        width = region['right'] - region['left']
+        height = region['bottom'] - region['top']
+        svg.set('width', output_format.format_number(width))
+        svg.set('height', output_format.format_number(height))
+        svg.set('viewBox', ' '.join(output_format.format_number(v)
+            for v in (region['left'], region['top'], width, height)))
+    return svg
 
-    group_stack = [svg]
+def process_psd(psd, layer_cache=None, region=None, selected=None,
+        layers=None, output_format=DEFAULT_OUTPUT_FORMAT):
+    """Convert the layers of 'psd' (or just 'layers', a part of them) into
+    an <svg> element written in 'output_format'.  If 'region' is given, the
+    document shows only that part of the canvas, and only the layers whose
+    indices are in 'selected' (see 'select_layers') are converted.
+    """
+    svg = create_svg_root(psd, region, output_format)
+    pool = GradientPool()
+
+    if layers is None:
+        layers = psd['layers']
+    for item, extra_items in convert_layers(layers, psd['bounds'],
+            output_format, layer_cache, selected):
+        svg.extend(pool.intern(pooled_elements(item, extra_items)))
+    return svg
 
-    id_uses = {}
-    def choose_id(s):
-        if s in id_uses:
-            result = u'%s_%d' % (s, id_uses[s])
-            id_uses[s] += 1
+def pooled_elements(item, extra_items):
+    # The elements to write for a top-level item, in document order.
+    if item is None:
+        return extra_items
+    return extra_items + [item]
+
+# The namespaces declared once on the root of streamed output.
+STREAM_NSMAP = {None: NS_SVG, 'inkscape': NS_INK, 'xlink': NS_XLINK}
+
+def write_psd_streaming(psdr, out, output_format=DEFAULT_OUTPUT_FORMAT):
+    """Convert the PSD read by 'psdr' and write the SVG to the file 'out' as
+    the layers are parsed.  A group's start tag is written as soon as the
+    records up to its closing divider (which carries its name and mask) have
+    been read, and each layer is serialized and released as soon as it is
+    converted.  So the memory held is the layer records of the current
+    top-level group, plus the SVG of a single layer.
+
+    Generated ids may be numbered differently than by 'process_psd', since
+    groups are finished before their contents rather than after.
+    """
+    psd = psdr.read_psd_header()
+    root = create_svg_root(psd, None, output_format)
+
+    with etree.xmlfile(out) as xf:
+        with xf.element(root.tag, root.attrib, nsmap=STREAM_NSMAP):
+            write_layer_tree(xf, group_layers(psdr.iter_layers()),
+                    psd['bounds'], output_format, GradientPool(),
+                    make_id_chooser())
+
+def group_layers(layers):
+    """Arrange the flat sequence of 'layers' into a tree, yielding a
+    (layer, children) pair for each top-level item.  'children' is None for
+    an ordinary layer, or the list of pairs inside a group whose closing
+    divider is 'layer'.  Groups are yielded once their closing divider has
+    been read.
+    """
+    # The children of the groups that are still open, innermost last.
+    group_stack = []
+    for layer in layers:
+        layer_type = get_layer_type(layer)
+        if layer_type == 0:
+            node = (layer, None)
+        elif layer_type in (1,2):
+            node = (layer, group_stack.pop())
+        elif layer_type == 3:
+            group_stack.append([])
+            continue
         else:
-            result = s
-            id_uses[s] = 1
-        return result
-
-    for layer in psd['layers']:
-        extra = layer['extra']
+            assert False, 'bad layer type %d' % layer_type
 
-        if 'lsct' in extra:
-            layer_type = extra['lsct']['type']
-        elif 'lsdk' in extra:
-            layer_type = extra['lsdk']['type']
+        if group_stack:
+            group_stack[-1].append(node)
         else:
-            # 0 is the default
-            layer_type = 0
-
+            yield node
+
+def write_layer_tree(xf, nodes, image_bounds, output_format, pool,
+        choose_id):
+    """Convert the (layer, children) pairs 'nodes' from 'group_layers' and
+    write them to the xmlfile 'xf', one layer at a time.
+    """
+    for layer, children in nodes:
+        if children is None:
+            item, extra_items = process_shape_layer(layer, image_bounds,
+                    output_format)
+            if item is not None:
+                set_item_attributes(item, layer, choose_id, output_format)
+            for element in pool.intern(
+                    pooled_elements(item, extra_items or [])):
+                write_element(xf, element)
+            continue
+
+        group = new_group()
+        extra_items = finish_group(group, layer, image_bounds, output_format)
+        set_item_attributes(group, layer, choose_id, output_format)
+        for element in pool.intern(extra_items):
+            write_element(xf, element)
+        with xf.element(group.tag, group.attrib):
+            write_layer_tree(xf, children, image_bounds, output_format, pool,
+                    choose_id)
+
+def write_element(xf, element):
+    """Write 'element' to the xmlfile 'xf'.  Unlike xf.write(), this uses the
+    namespaces declared on the enclosing elements instead of declaring them
+    again.
+    """
+    with xf.element(element.tag, element.attrib):
+        if element.text:
+            xf.write(element.text)
+        for child in element:
+            write_element(xf, child)
+            if child.tail:
+                xf.write(child.tail)
+
+def get_layer_type(layer):
+    """Return the layer's section divider type: 0 for ordinary layers, 1 or 2
+    for the end of a group (carrying the group's name and mask), and 3 for
+    its start.
+    """
+    extra = layer['extra']
+    if 'lsct' in extra:
+        return extra['lsct']['type']
+    elif 'lsdk' in extra:
+        return extra['lsdk']['type']
+    else:
+        # 0 is the default
+        return 0
+
+def convert_layers(layers, image_bounds, output_format, layer_cache=None,
+        selected=None):
+    """Convert a sequence of PSD layers, yielding an (item, extra_items) pair
+    for each completed top-level item.  Group layers are yielded once their
+    closing divider has been seen.
+
+    If 'layer_cache' is given, shape layers with a 'fingerprint' reuse the
+    SVG generated the last time a layer with identical data was converted.
+
+    If 'selected' is given, only the ordinary layers whose indices are in it
+    are converted, and groups left empty are dropped.
+    """
+    # Groups that are still open, innermost last.
+    group_stack = []
+    choose_id = make_id_chooser()
+
+    for index, layer in enumerate(layers):
+        extra = layer['extra']
+        layer_type = get_layer_type(layer)
 
         item = None
         extra_items = None
 
         if layer_type == 0:
-            item, extra_items = process_shape_layer(layer, psd['bounds'])
+            if selected is not None and index not in selected:
+                continue
+            item, extra_items = process_shape_layer_cached(layer,
+                    image_bounds, layer_cache, output_format)
         elif layer_type in (1,2):
             item = group_stack.pop()
-            item.set('{%s}label' % NS_INK, extra['luni'])
-            if 'vmsk' in extra:
-                extra_items = apply_vector_mask_to_group(
-                        item, extra['vmsk'], psd['bounds'])
-            elif 'vsms' in extra:
-                extra_items = apply_vector_mask_to_group(
-                        item, extra['vsms'], psd['bounds'])
+            if selected is not None and len(item) == 0:
+                # Nothing in the group was selected.
+                item = None
+            else:
+                extra_items = finish_group(item, layer, image_bounds,
+                        output_format) or None
         elif layer_type == 3:
             # Don't add anything to the document until we see the end of the
             # group.
-            group = etree.Element('{%s}g' % NS_SVG)
-            group.set('{%s}groupmode' % NS_INK, 'layer')
-            group_stack.append(group)
+            group_stack.append(new_group())
         else:
             assert False, 'bad layer type %d' % layer_type
 
         if item is not None:
-            item.set('id', choose_id(extra['luni']))
-            if layer['flags'] & 2 != 0:
-                # layer is hidden
-                item.set('display', 'none')
-            if layer['opacity'] != 255:
-                # TODO: For <g>s, we should set the opacity using a mask
-                # instead.  <g opacity=...> sets the opacity for each element
-                # of the group separately, so when two paths in the group
-                # overlap, you can see both of them instead of just the topmost
-                # one.
-                item.set('opacity', '%f' % (layer['opacity'] / 255.0))
+            set_item_attributes(item, layer, choose_id, output_format)
+
+        if not group_stack:
+            if item is not None or extra_items:
+                yield item, extra_items or []
+            continue
 
         if extra_items is not None:
             group_stack[-1].extend(extra_items)
         if item is not None:
             group_stack[-1].append(item)
 
-    return svg
+def make_id_chooser():
+    """Return a function that turns a layer name into an element id, adding
+    a numeric suffix to names that were used before.
+    """
+    id_uses = {}
+    def choose_id(s):
+        if s in id_uses:
+            result = u'%s_%d' % (s, id_uses[s])
+            id_uses[s] += 1
+        else:
+            result = s
+            id_uses[s] = 1
+        return result
+    return choose_id
 
+def new_group():
+    group = etree.Element('{%s}g' % NS_SVG)
+    group.set('{%s}groupmode' % NS_INK, 'layer')
+    return group
 
-def process_shape_layer(layer, image_bounds):
+def finish_group(group, layer, image_bounds, output_format):
+    """Label 'group' and apply the vector mask of 'layer', its closing
+    divider.  Returns the elements to place before the group.
+    """
+    extra = layer['extra']
+    group.set('{%s}label' % NS_INK, extra['luni'])
+    if 'vmsk' in extra:
+        return apply_vector_mask_to_group(group, extra['vmsk'], image_bounds,
+                output_format)
+    elif 'vsms' in extra:
+        return apply_vector_mask_to_group(group, extra['vsms'], image_bounds,
+                output_format)
+    return []
+
+def set_item_attributes(item, layer, choose_id, output_format):
+    # The id, visibility and opacity of a finished layer or group.
+    item.set('id', choose_id(layer['extra']['luni']))
+    if layer['flags'] & 2 != 0:
+        # layer is hidden
+        item.set('display', 'none')
+    if layer['opacity'] != 255:
+        # TODO: For <g>s, we should set the opacity using a mask
+        # instead.  <g opacity=...> sets the opacity for each element
+        # of the group separately, so when two paths in the group
+        # overlap, you can see both of them instead of just the topmost
+        # one.
+        item.set('opacity', output_format.format_fraction(
+            layer['opacity'] / 255.0))
+
+
+def process_shape_layer_cached(layer, image_bounds, layer_cache,
+        output_format):
+    """Like 'process_shape_layer', but reuses a previously generated result
+    from 'layer_cache' if the layer's data hasn't changed.
+    """
+    if layer_cache is None or 'fingerprint' not in layer:
+        return process_shape_layer(layer, image_bounds, output_format)
+
+    key = make_key('layer', layer['fingerprint'], sorted(image_bounds.items()),
+            output_format.key())
+
+    data = layer_cache.get(key)
+    if data is not None:
+        # The fragment holds the extra items followed by the item itself.
+        fragment = etree.fromstring(data)
+        elements = list(fragment)
+        renumber_ids(elements)
+        if fragment.get('has-item') == 'true':
+            return elements[-1], elements[:-1]
+        return None, elements
+
+    item, extra_items = process_shape_layer(layer, image_bounds,
+            output_format)
+
+    fragment = etree.Element('fragment')
+    fragment.set('has-item', 'true' if item is not None else 'false')
+    fragment.extend(extra_items)
+    if item is not None:
+        fragment.append(item)
+    layer_cache.put(key, etree.tostring(fragment))
+
+    # Appending to 'fragment' moved the elements; detach them again.
+    for element in list(fragment):
+        fragment.remove(element)
+    return item, extra_items
+
+def process_shape_layer(layer, image_bounds, output_format):
     extra = layer['extra']
 
-    color, color_extra = get_fill_for_layer(layer)
+    color, color_extra = get_fill_for_layer(layer, output_format)
     if 'vmsk' in extra:
         path, path_extra = construct_path_from_vector_mask(extra['vmsk'],
-                image_bounds)
+                image_bounds, output_format)
     elif 'vsms' in extra:
         path, path_extra = construct_path_from_vector_mask(extra['vsms'],
-                image_bounds)
+                image_bounds, output_format)
     else:
         path, path_extra = None, []
 
+    if color is None and path is None and 'image' in layer:
+        # A pixel layer.
+        image = construct_image(layer['image'], output_format)
+        if image is not None:
+            image.set('{%s}label' % NS_INK, extra['luni'])
+        return image, []
+
     if color is not None and path is None:
         # For layers with fill but no vector mask, draw a box the size of the
         # image.
-        path = construct_box_path(layer['bounds'])
+        path = construct_box_path(layer['bounds'], output_format)
     elif color is None:
         # Make it obvious that we couldn't find the right color.
         color = 'rgb(255, 0, 255)'
@@ -134,48 +369,75 @@ def process_shape_layer(layer, image_bounds):
 
     return path, path_extra + color_extra
 
-def get_fill_for_layer(layer):
-    extra = layer['extra']
-
+def find_fill(extra):
+    """Return where the fill of a layer with the additional layer info
+    'extra' comes from, as a (kind, value, base_color) tuple where kind is
+    'gradient' (value is the descriptor), 'color' or 'none'.  Returns None
+    if the layer has no fill.
+    """
     if 'lfx2' in extra \
             and extra['lfx2']['masterFXSwitch'] == True \
             and 'GrFl' in extra['lfx2'] \
             and extra['lfx2']['GrFl']['enab']:
 
         base_color = extra['SoCo']['Clr '] if 'SoCo' in extra else None
-        gradient = construct_gradient(extra['lfx2']['GrFl'], layer['bounds'], base_color)
-        gradient.set('id', next_id())
-
-        return 'url(#%s)' % gradient.get('id'), [gradient]
+        return 'gradient', extra['lfx2']['GrFl'], base_color
     elif 'SoCo' in extra:
-        return parse_color(extra['SoCo']['Clr ']), []
+        return 'color', extra['SoCo']['Clr '], None
     elif 'vscg' in extra:
         if 'vstk' in extra and not extra['vstk']['fillEnabled']:
-            return 'none', []
+            return 'none', None, None
 
         d_vscg = extra['vscg']
         if 'SoCo' in d_vscg:
-            return parse_color(d_vscg['SoCo']['Clr ']), []
+            return 'color', d_vscg['SoCo']['Clr '], None
         elif 'GrFl' in d_vscg:
-            gradient = construct_gradient(d_vscg['GrFl'], layer['bounds'])
-            gradient.set('id', next_id())
+            return 'gradient', d_vscg['GrFl'], None
+    return None
 
-            return 'url(#%s)' % gradient.get('id'), [gradient]
-        else:
-            return None, []
-    else:
+def get_fill_for_layer(layer, output_format):
+    fill = find_fill(layer['extra'])
+    if fill is None:
         return None, []
 
-def construct_path_from_vector_mask(vmsk, image_bounds):
-    path, path_mask = construct_path(vmsk['path_records'], vmsk['flags'], image_bounds)
+    kind, value, base_color = fill
+    if kind == 'none':
+        return 'none', []
+    elif kind == 'color':
+        return parse_color(value), []
+
+    gradient = construct_gradient(value, layer['bounds'], output_format,
+            base_color)
+    gradient.set('id', next_id())
+
+    return 'url(#%s)' % gradient.get('id'), [gradient]
+
+def is_pixel_layer(layer):
+    """Return True if 'process_shape_layer' writes 'layer' as an <image>."""
+    extra = layer['extra']
+    return get_layer_type(layer) == 0 and 'image' in layer \
+            and 'vmsk' not in extra and 'vsms' not in extra \
+            and find_fill(extra) is None
+
+def get_path_records(vmsk):
+    # Path records are either a list of dicts or, if the reader was asked for
+    # them, a single numpy array.
+    if 'path_array' in vmsk:
+        return vmsk['path_array']
+    return vmsk['path_records']
+
+def construct_path_from_vector_mask(vmsk, image_bounds, output_format):
+    path, path_mask = construct_path(get_path_records(vmsk), vmsk['flags'],
+            image_bounds, output_format)
     if path_mask is None:
         path_extra = []
     else:
         path_extra = [path_mask]
     return path, path_extra
 
-def apply_vector_mask_to_group(group, vmsk, image_bounds):
-    path, path_mask = construct_path(vmsk['path_records'], vmsk['flags'], image_bounds)
+def apply_vector_mask_to_group(group, vmsk, image_bounds, output_format):
+    path, path_mask = construct_path(get_path_records(vmsk), vmsk['flags'],
+            image_bounds, output_format)
 
     if path_mask is not None:
         # Use 'path' as a mask.
@@ -202,7 +464,10 @@ def apply_vector_mask_to_group(group, vmsk, image_bounds):
         return [clip]
 
 
-def construct_box_path(bounds):
+def construct_box_path(bounds, output_format):
+    # An empty box would be a zero-size <rect>; keep the path for those.
+    if output_format.shapes and not is_empty(bounds):
+        return construct_box(bounds, output_format)
     data = box_path_data(bounds)
     path = etree.Element('{%s}path' % NS_SVG)
     path.set('d', data)
@@ -210,21 +475,420 @@ def construct_box_path(bounds):
 
 
 
-if __name__ == '__main__':
-    if sys.argv[1] == '-d':
-        filename = sys.argv[2]
-        debug = True
+def layer_extent(layer, image_bounds):
+    """Return the box an ordinary layer draws into, or None if it draws
+    nothing.  The layer's own bounds are used when they aren't empty, so
+    most layers' additional info doesn't need to be decoded; otherwise the
+    extent comes from its vector mask.
+    """
+    if not is_empty(layer['bounds']):
+        return layer['bounds']
+
+    extra = layer['extra']
+    for tag in ('vmsk', 'vsms'):
+        if tag in extra:
+            vmsk = extra[tag]
+            if vmsk['flags'] & 5 != 0:
+                # Disabled or inverted masks cover the whole image.
+                return image_bounds
+            return psd_path_records_bounds(get_path_records(vmsk),
+                    image_bounds)
+    return None
+
+def select_layers(layers, image_bounds, region):
+    """Return the set of indices of the ordinary layers in 'layers' that
+    draw into 'region'.
+    """
+    index = GridIndex(image_bounds)
+    for i, layer in enumerate(layers):
+        if get_layer_type(layer) == 0:
+            extent = layer_extent(layer, image_bounds)
+            if extent is not None:
+                index.insert(i, extent)
+    return index.query(region)
+
+def find_artboard(layers, name, image_bounds):
+    """Return the combined extent of the layers in the group called 'name',
+    or None if there is no such group (or it draws nothing).
+    """
+    # The extents of the groups that are still open, innermost last.
+    extents = [None]
+    for layer in layers:
+        layer_type = get_layer_type(layer)
+        if layer_type == 0:
+            extents[-1] = union(extents[-1],
+                    layer_extent(layer, image_bounds))
+        elif layer_type == 3:
+            extents.append(None)
+        elif len(extents) > 1:
+            extent = extents.pop()
+            if layer['extra']['luni'] == name and extent is not None:
+                return extent
+            extents[-1] = union(extents[-1], extent)
+    return None
+
+def resolve_region(psd, region=None, artboard=None):
+    """Return the region to convert: 'region' itself, or the extent of the
+    group called 'artboard'.  Raises ValueError if there is no such group.
+    """
+    if artboard is not None:
+        region = find_artboard(psd['layers'], artboard, psd['bounds'])
+        if region is None:
+            raise ValueError('no artboard named %r' % artboard)
+    return region
+
+def convert_psd_file(filename, cache=None, image_jobs=1, region=None,
+        artboard=None, output_format=DEFAULT_OUTPUT_FORMAT):
+    """Convert the PSD file 'filename', returning the SVG serialized in
+    'output_format'.  If a ConversionCache is given, a previous result for
+    the same file contents and output format is returned without parsing the
+    file.
+
+    Unless 'image_jobs' is 1, the pixel layers are decoded in parallel by
+    that many processes (or one per CPU, if it is None).
+
+    If a 'region' (bounds) or an 'artboard' name is given, only the layers
+    drawing into that region are converted.  The other layers are indexed
+    but never decoded.
+    """
+    if cache is not None:
+        key = make_key(hash_file(filename), output_format.key(),
+                region and sorted(region.items()), artboard)
+        svg = cache.get(key, os.path.getsize(filename))
+        if svg is not None:
+            return svg
+
+    reset_ids()
+    if cache is None:
+        partial = region is not None or artboard is not None
+        with open(filename, 'rb') as f, PSDReader(f, path_arrays=True,
+                lazy=partial, descriptor_keys=DESCRIPTOR_KEYS,
+                wanted_tags=LAYER_INFO_TAGS,
+                images=output_format.images) as psdr:
+            psd = psdr.read_psd()
+            region = resolve_region(psd, region, artboard)
+            selected = None
+            layers = psd['layers']
+            if region is not None:
+                selected = select_layers(layers, psd['bounds'], region)
+                layers = [layers[i] for i in sorted(selected)]
+            if output_format.images and image_jobs != 1:
+                with ParallelImageDecoder(filename, image_jobs) as decoder:
+                    decoder.schedule(psdr, [layer for layer in layers
+                        if is_pixel_layer(layer)])
+                    svg = etree.tostring(process_psd(psd, None, region,
+                        selected, output_format=output_format))
+            else:
+                svg = etree.tostring(process_psd(psd, None, region,
+                    selected, output_format=output_format))
     else:
-        filename = sys.argv[1]
-        debug = False
+        # Even if the file as a whole changed, most of its layers probably
+        # didn't.  Reuse their fragments from the same cache directory, and
+        # parse layers lazily so unchanged ones are never fully decoded.
+        layer_cache = cache.layers
+        with open(filename, 'rb') as f, PSDReader(f, path_arrays=True,
+                lazy=True, fingerprints=True, descriptor_keys=DESCRIPTOR_KEYS,
+                wanted_tags=LAYER_INFO_TAGS,
+                images=output_format.images) as psdr:
+            psd = psdr.read_psd()
+            region = resolve_region(psd, region, artboard)
+            selected = None
+            if region is not None:
+                selected = select_layers(psd['layers'], psd['bounds'],
+                        region)
+            svg = etree.tostring(process_psd(psd, layer_cache, region,
+                selected, output_format=output_format))
+
+    if cache is not None:
+        cache.put(key, svg)
+    return svg
 
-    with open(filename, 'rb') as f:
-        psdr = PSDReader(f)
-        psd = psdr.read_psd()
+# The document being split, shared with the worker processes that write the
+# files (see 'split_psd_file').
+_split_psd = None
+
+def split_groups(layers):
+    """Divide 'layers' into its top-level groups.  Returns a list of (name,
+    indices) pairs, one per group, plus one named None for the layers that
+    aren't in any group (if there are any).
+    """
+    groups = []
+    ungrouped = []
+    depth = 0
+    for index, layer in enumerate(layers):
+        layer_type = get_layer_type(layer)
+        if layer_type == 3:
+            if depth == 0:
+                indices = []
+            depth += 1
+        elif layer_type in (1, 2):
+            depth -= 1
+        elif depth == 0:
+            ungrouped.append(index)
+            continue
+        indices.append(index)
+        if depth == 0:
+            groups.append((layer['extra']['luni'], indices))
+
+    if ungrouped:
+        groups.append((None, ungrouped))
+    return groups
+
+def split_filenames(names, output_dir):
+    """Choose a distinct file name in 'output_dir' for each group name."""
+    used = set()
+    filenames = []
+    for name in names:
+        if name is None:
+            name = u'ungrouped'
+        base = re.sub(r'[^\w\-. ]+', u'_', name, flags=re.UNICODE).strip()
+        base = base.lstrip('.') or u'group'
+        candidate = base
+        count = 1
+        while candidate.lower() in used:
+            count += 1
+            candidate = u'%s_%d' % (base, count)
+        used.add(candidate.lower())
+        filenames.append(os.path.join(output_dir, candidate + u'.svg'))
+    return filenames
+
+def write_split_file(task):
+    """Convert the layers with the given indices of the document being
+    split, and write them to their own SVG file.  Returns the file name.
+    """
+    indices, filename, output_format = task
+    reset_ids()
+    layers = [_split_psd['layers'][i] for i in indices]
+    svg = etree.tostring(process_psd(_split_psd, layers=layers,
+        output_format=output_format))
+    with open(filename, 'wb') as f:
+        f.write(svg)
+    return filename
+
+def init_split_worker(filename, images):
+    global _split_psd
+    if _split_psd is None:
+        # Not forked from the parent, so index the file again.  The file
+        # stays open for the lifetime of the process.
+        psdr = PSDReader(open(filename, 'rb'), path_arrays=True, lazy=True,
+                descriptor_keys=DESCRIPTOR_KEYS, wanted_tags=LAYER_INFO_TAGS,
+                images=images)
+        _split_psd = psdr.read_psd()
+
+def split_psd_file(filename, output_dir, jobs=1,
+        output_format=DEFAULT_OUTPUT_FORMAT):
+    """Write each top-level group of the PSD file 'filename' to its own SVG
+    file in 'output_dir', and the layers outside any group to one more.
+    Each file only contains the gradients and masks its own layers use.
+
+    The file is parsed once.  Unless 'jobs' is 1, the groups are converted
+    and written by that many processes (or one per CPU, if it is None),
+    which share the parsed layers.  Returns the names of the files written.
+    """
+    global _split_psd
+    with open(filename, 'rb') as f, PSDReader(f, path_arrays=True,
+            lazy=True, descriptor_keys=DESCRIPTOR_KEYS,
+            wanted_tags=LAYER_INFO_TAGS,
+            images=output_format.images) as psdr:
+        _split_psd = psdr.read_psd()
+        try:
+            groups = split_groups(_split_psd['layers'])
+            filenames = split_filenames([name for name, indices in groups],
+                    output_dir)
+            output_format = output_format.replace(svg_dir=output_dir)
+            tasks = [(indices, name, output_format) for (group, indices), name
+                    in zip(groups, filenames)]
+            if jobs == 1 or len(tasks) < 2:
+                return map(write_split_file, tasks)
+
+            pool = multiprocessing.Pool(jobs, init_split_worker,
+                    (filename, output_format.images))
+            try:
+                return pool.map(write_split_file, tasks)
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            _split_psd = None
+
+def convert_composite(filename, output_format=DEFAULT_OUTPUT_FORMAT):
+    """Convert only the merged image of the PSD file 'filename' (for
+    thumbnails, say), returning the serialized SVG.
+    """
+    reset_ids()
+    with open(filename, 'rb') as f, PSDReader(f) as psdr:
+        image = psdr.read_composite()
+        svg = create_svg_root(psdr.psd, None, output_format)
+        if image is not None:
+            svg.append(construct_image(image, output_format))
+    return etree.tostring(svg)
+
+def add_output_options(parser):
+    parser.add_option('--precision', type='int', default=-1,
+            help='number of decimal places in coordinates (-1 for the '
+                 'default of six, untrimmed)')
+    parser.add_option('--snap', type='float', default=0,
+            help='round coordinates to a grid of this size, e.g. 1 for '
+                 'whole pixels (0 to disable)')
+    parser.add_option('--compact', type='choice', choices=['true', 'false'],
+            default='false',
+            help='write paths with compact (and relative) commands')
+    parser.add_option('--simplify', type='choice', choices=['true', 'false'],
+            default='false',
+            help='turn straight curves into lines and drop redundant nodes')
+    parser.add_option('--fit-tolerance', '--fit_tolerance',
+            dest='fit_tolerance', type='float', default=0,
+            help='with --simplify, merge curves that can be replaced by one '
+                 'within this many pixels (0 to disable)')
+    parser.add_option('--shapes', type='choice', choices=['true', 'false'],
+            default='false',
+            help='write rectangles, rounded rectangles and ellipses as '
+                 '<rect> and <ellipse> elements')
+    parser.add_option('--boolean', type='choice', choices=['true', 'false'],
+            default='false',
+            help='combine subtracted, intersected and excluded subpaths '
+                 'into one path instead of using masks; curves that cross '
+                 'another subpath become lines within 0.05 pixels, which '
+                 'looks the same but is bigger and harder to edit')
+    parser.add_option('--images', type='choice', choices=['true', 'false'],
+            default='true',
+            help='embed pixel layers as PNG images')
+    # Inkscape passes the .inx parameters under their own names, with
+    # underscores.
+    parser.add_option('--tile-size', '--tile_size', dest='tile_size',
+            type='int', default=0,
+            help='split pixel layers into tiles of this many pixels, '
+                 'leaving out fully transparent ones (0 to disable)')
+    parser.add_option('--image-dir', '--image_dir', dest='image_dir',
+            default='',
+            help='write the PNG images to this directory and link to them, '
+                 'instead of embedding them')
+    parser.add_option('--previews', type='int', default=0,
+            help='number of half-resolution preview levels to add to each '
+                 'pixel layer (hidden)')
+
+def add_cache_options(parser):
+    parser.add_option('--cache-dir', default=None,
+            help='reuse conversion results stored in this directory')
+    parser.add_option('--cache-size', type='int', default=256,
+            help='maximum size of the cache in megabytes (default: 256)')
+
+def open_cache(options):
+    if options.cache_dir is None:
+        return None
+    return ConversionCache(options.cache_dir, options.cache_size << 20)
+
+def format_cache_stats(stats):
+    return 'cache: %(hits)d hits, %(misses)d misses, %(bytes_saved)d bytes ' \
+            'saved; layers: %(layer_hits)d hits, %(layer_misses)d misses\n' \
+            % stats
+
+def get_output_format(options):
+    """Build the OutputFormat selected by the output options."""
+    return OutputFormat(
+            precision=options.precision if options.precision >= 0 else None,
+            snap=options.snap or None,
+            compact=options.compact == 'true',
+            images=options.images == 'true',
+            tile_size=options.tile_size or None,
+            image_dir=options.image_dir or None,
+            previews=options.previews,
+            simplify=options.simplify == 'true',
+            fit_tolerance=options.fit_tolerance or None,
+            shapes=options.shapes == 'true',
+            boolean=options.boolean == 'true')
+
+def parse_args(argv):
+    parser = optparse.OptionParser(usage='%prog [options] FILE.psd')
+    parser.add_option('-d', '--debug', action='store_true', default=False,
+            help='dump the parsed PSD structure instead of converting it')
+    parser.add_option('--tags', default=None,
+            help='with -d, only decode these comma-separated additional '
+                 'layer info tags (e.g. luni,lsct)')
+    parser.add_option('--stream', action='store_true', default=False,
+            help='write the SVG incrementally while the PSD is parsed')
+    parser.add_option('--composite', action='store_true', default=False,
+            help='only convert the merged image, skipping the layers')
+    parser.add_option('--image-jobs', type='int', default=1,
+            help='number of processes decoding pixel layers (0 for one '
+                 'per CPU, default: 1)')
+    parser.add_option('--cache-stats', action='store_true', default=False,
+            help='print cache statistics to stderr')
+    parser.add_option('--region', default='',
+            help='only convert the layers drawing into this part of the '
+                 'canvas, given as x,y,w,h')
+    parser.add_option('--artboard', default='',
+            help='only convert the layers drawing into the area of the '
+                 'group (artboard) with this name')
+    parser.add_option('--split', default=None, metavar='DIR',
+            help='write each top-level group to its own SVG file in DIR')
+    parser.add_option('--split-jobs', type='int', default=1,
+            help='with --split, number of processes writing files (0 for '
+                 'one per CPU, default: 1)')
+    add_output_options(parser)
+    add_cache_options(parser)
+    options, args = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error('expected exactly one input file')
+    if options.region:
+        try:
+            options.region = parse_region(options.region)
+        except ValueError as e:
+            parser.error(str(e))
+    if (options.region or options.artboard) \
+            and (options.stream or options.composite):
+        parser.error('--region and --artboard need the full conversion')
+    if options.split is not None and (options.region or options.artboard
+            or options.stream or options.composite):
+        parser.error('--split writes whole groups; it can\'t be combined '
+                'with --region, --artboard, --stream or --composite')
+    if options.image_jobs != 1 and (options.cache_dir is not None
+            or options.split is not None or options.stream
+            or options.composite):
+        parser.error('--image-jobs only applies to a full conversion; it '
+                'can\'t be combined with --cache-dir, --split, --stream or '
+                '--composite')
+    return options, args[0]
+
+if __name__ == '__main__':
+    options, filename = parse_args(sys.argv[1:])
+    debug = options.debug
+
+    output_format = get_output_format(options)
 
     if debug:
-        pprint(psd)
+        wanted_tags = set(options.tags.split(',')) \
+                if options.tags is not None else None
+        with open(filename, 'rb') as f, \
+                PSDReader(f, wanted_tags=wanted_tags) as psdr:
+            pprint(psdr.read_psd())
+        stats = psdr.descriptor_cache.stats()
+        sys.stderr.write('descriptor cache: %d hits, %d misses '
+                '(%.1f%% hit rate)\n' % (stats['hits'], stats['misses'],
+                    100 * stats['hit_rate']))
+        sys.exit(0)
+
+    if options.composite:
+        print(convert_composite(filename, output_format))
+        sys.exit(0)
+
+    if options.stream:
+        with open(filename, 'rb') as f, PSDReader(f, path_arrays=True,
+                descriptor_keys=DESCRIPTOR_KEYS, wanted_tags=LAYER_INFO_TAGS,
+                images=output_format.images) as psdr:
+            write_psd_streaming(psdr, sys.stdout, output_format)
+        sys.exit(0)
+
+    if options.split is not None:
+        if not os.path.isdir(options.split):
+            os.makedirs(options.split)
+        for name in split_psd_file(filename, options.split,
+                options.split_jobs or None, output_format):
+            print(name.encode("utf-8"))
         sys.exit(0)
 
-    svg = process_psd(psd)
-    print(etree.tostring(svg))
+    cache = open_cache(options)
+    print(convert_psd_file(filename, cache, options.image_jobs or None,
+        options.region or None, options.artboard or None, output_format))
+    if cache is not None and options.cache_stats:
+        sys.stderr.write(format_cache_stats(cache.stats()))